@@ -0,0 +1,78 @@
+"""
+Measures the memory cost of actors and the allocations made per step.
+
+Run from the repository root:
+
+    python benchmarks/actor_memory.py [steps]
+
+Reports, for the default config and for a config with 10x the population,
+the bytes per actor and, per step, the number of actors spawned and the
+peak number of bytes allocated while stepping.
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from simulate import Simulation
+
+
+def scaled_config(factor):
+    """ Returns config with factor times the grid area and population. """
+    class Scaled:
+        class Mosquito(config.Mosquito):
+            n = config.Mosquito.n * factor
+
+        class Human(config.Human):
+            n = config.Human.n * factor
+
+        class Grid(config.Grid):
+            size = (round(config.Grid.size[0] * factor ** 0.5),
+                    round(config.Grid.size[1] * factor ** 0.5))
+    return Scaled
+
+
+def measure(cfg, steps):
+    sim = Simulation(cfg, seed=0)
+
+    # Actor memory: what a population's worth of fresh actors costs, without
+    # the registry and grid bookkeeping of spawning them.
+    n = sim.num_actors()
+    classes = [type(actor) for actor in sim.actors]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    actors = [cls(sim, cfg, has_vaccine=False, use_net=False) for cls in classes]
+    per_actor = (tracemalloc.get_traced_memory()[0] - before) / n
+    del actors
+
+    spawned = peak = 0
+    for _ in range(steps):
+        ids = {id(actor) for actor in sim.actors}
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        sim.step()
+        peak += tracemalloc.get_traced_memory()[1] - before
+        spawned += sum(1 for actor in sim.actors if id(actor) not in ids)
+    tracemalloc.stop()
+
+    return {
+        'actors': n,
+        'bytes_per_actor': per_actor,
+        'spawned_per_step': spawned / steps,
+        'peak_bytes_per_step': peak / steps,
+    }
+
+
+def main(steps=50):
+    for name, factor in (('default', 1), ('10x', 10)):
+        result = measure(scaled_config(factor), steps)
+        print(f"{name:>8}: {result['actors']} actors, "
+              f"{result['bytes_per_actor']:.0f} bytes/actor, "
+              f"{result['spawned_per_step']:.1f} spawned/step, "
+              f"{result['peak_bytes_per_step'] / 1024:.0f} KiB peak/step")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
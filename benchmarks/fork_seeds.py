@@ -0,0 +1,66 @@
+"""
+Checks that forks of a running simulation given different seeds diverge.
+
+Run from the repository root:
+
+    python benchmarks/fork_seeds.py [steps]
+
+For every engine that can fork, with and without fast_random, runs a
+simulation for a number of steps, forks it twice with different seeds and
+once without a seed, and compares the random draws and the state of the
+forks after some more steps. Exits with status 1 if forks with different
+seeds draw the same numbers, or a fork without a seed doesn't continue
+exactly like the original.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from headless import make_simulation, run
+
+
+ENGINES = ('object', 'event', 'cohort')
+
+
+def draws(sim, n=20):
+    """ Returns the next n draws of every generator of sim. """
+    generators = [[sim.random.random() for _ in range(n)]]
+    if hasattr(sim, 'np_random'):
+        generators.append(sim.np_random.random(n).tolist())
+    return generators
+
+
+def state(sim, steps):
+    """ Returns the stats of sim after running it steps steps. """
+    run(sim, steps)
+    return sim.stats.get_state()
+
+
+def check(engine, fast_random, steps):
+    sim = make_simulation(config, 1, engine, fast_random)
+    run(sim, steps)
+    problems = []
+    if any(a == b for a, b in zip(draws(sim.fork(seed=1)), draws(sim.fork(seed=2)))):
+        problems.append("forks with seeds 1 and 2 draw the same numbers")
+    if state(sim.fork(seed=1), steps) == state(sim.fork(seed=2), steps):
+        problems.append("forks with seeds 1 and 2 have the same stats")
+    if state(sim.fork(), steps) != state(sim, steps):
+        problems.append("a fork without a seed doesn't continue like the original")
+    return problems
+
+
+def main(steps=100):
+    failed = False
+    for engine in ENGINES:
+        for fast_random in (False, True):
+            problems = check(engine, fast_random, steps)
+            failed = failed or bool(problems)
+            name = f"{engine}{' (fast_random)' if fast_random else ''}"
+            print(f"{name:>22}: {'; '.join(problems) or 'ok'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
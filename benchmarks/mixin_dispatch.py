@@ -0,0 +1,59 @@
+"""
+Micro-benchmark of actor construction and step dispatch through MixinBase.
+
+Run from the repository root:
+
+    python benchmarks/mixin_dispatch.py [n_actors]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from simulate import Simulation, Human, Mosquito
+
+
+class BenchConfig:
+    """ A config without an initial population, so only our actors exist. """
+    class Mosquito(config.Mosquito):
+        n = 0
+
+    class Human(config.Human):
+        dens = 0
+        populate_absolute = True
+        n = 0
+
+    Grid = config.Grid
+
+
+def construct(sim, n):
+    for i in range(n):
+        Human(sim, sim.config, use_net=False)
+        Mosquito(sim, sim.config, has_vaccine=False)
+
+
+def step(actors):
+    for actor in actors:
+        actor.all_super_step()
+        actor._dead = False
+        actor.all_super_end_step()
+
+
+def main(n=10000, repeat=5):
+    sim = Simulation(BenchConfig)
+    actors = [cls(sim, sim.config, has_vaccine=False, use_net=False)
+              for i in range(n) for cls in (Human, Mosquito)]
+
+    results = {
+        'construct': min(timeit.repeat(lambda: construct(sim, n), number=1, repeat=repeat)),
+        'step': min(timeit.repeat(lambda: step(actors), number=1, repeat=repeat)),
+    }
+    for name, seconds in results.items():
+        print(f"{name:>10}: {seconds / (2 * n) * 1e6:.3f} us per actor")
+    return results
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,181 @@
+"""
+Scaling benchmark of the simulation core.
+
+Run from the repository root:
+
+    python benchmarks/scaling.py [--scales 1 2 4] [--steps 200] \
+        [--output results.json] [--compare old_results.json]
+
+Builds simulations for a range of sizes (every scale multiplies the grid
+area, the number of humans and the number of mosquitos of config) and for
+every scenario, and measures the time to populate the grid, steps/sec, the
+time per SimStats.step and the peak memory of populating and stepping. The
+scenarios switch on the branches of handle_death and new_mosquito that the
+default run doesn't take from the start: clustered respawning of mosquitos,
+vaccinated mosquitos and nets.
+
+The results are written as JSON; --compare prints the speed-up of every
+measurement relative to an earlier results file.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import headless
+from profiling import timed
+
+
+# Config overrides and interventions (see headless.INTERVENTIONS) per
+# scenario. Interventions are switched on before the first step.
+SCENARIOS = {
+    'scattered': ({'cluster': False}, ()),
+    'clustered': ({'cluster': True}, ()),
+    'vax': ({'cluster': True}, ('vax',)),
+    'net': ({'cluster': True}, ('net',)),
+    'vax+net': ({'cluster': True}, ('vax', 'net')),
+}
+
+
+def make_config(scale=1, grid=None, human_dens=None, human_n=None, mosquito_n=None,
+                cluster=True, sparse=False):
+    """
+    Returns config with the grid area and population multiplied by scale,
+    unless grid (the size), human_dens, human_n or mosquito_n are given.
+    With sparse, the simulation uses a SparseGrid.
+    """
+    if grid is None:
+        grid = (round(config.Grid.size[0] * scale ** 0.5),
+                round(config.Grid.size[1] * scale ** 0.5))
+
+    class Scaled:
+        class Mosquito(config.Mosquito):
+            n = mosquito_n if mosquito_n is not None else round(config.Mosquito.n * scale)
+
+        class Human(config.Human):
+            dens = human_dens if human_dens is not None else config.Human.dens
+            n = human_n if human_n is not None else round(config.Human.n * scale)
+            populate_absolute = human_n is not None
+
+        class Grid(config.Grid):
+            size = grid
+
+    Scaled.Mosquito.cluster = Scaled.Human.cluster = cluster
+    Scaled.Grid.sparse = sparse
+    return Scaled
+
+
+def measure(cfg, interventions, steps, mem_steps, seed=0, engine='object'):
+    """
+    Runs a simulation of cfg twice: once timed, and once for mem_steps
+    steps while tracing allocations.
+    """
+    interventions = [(0, name) for name in interventions]
+
+    start = time.perf_counter()
+    sim = headless.make_simulation(cfg, seed, engine)
+    populated = time.perf_counter()
+
+    stats_step = [0, 0.0]
+    sim.stats.step = timed(sim.stats.step, stats_step)
+    headless.run(sim, steps, interventions)
+    finished = time.perf_counter()
+    headless.close(sim)
+
+    tracemalloc.start()
+    mem_sim = headless.make_simulation(cfg, seed, engine)
+    headless.run(mem_sim, mem_steps, interventions)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    headless.close(mem_sim)
+
+    return {
+        'grid': list(cfg.Grid.size),
+        'actors': sim.num_actors(),
+        'populate_s': populated - start,
+        'steps_per_sec': steps / (finished - populated),
+        'stats_step_us': 1e6 * stats_step[1] / max(stats_step[0], 1),
+        'peak_bytes': peak,
+    }
+
+
+def run(scales, scenarios, steps, mem_steps, seed=0, engine='object', sparse=False):
+    results = []
+    for scale in scales:
+        for name in scenarios:
+            overrides, interventions = SCENARIOS[name]
+            cfg = make_config(scale, sparse=sparse, **overrides)
+            result = {'scenario': name, 'scale': scale}
+            result.update(measure(cfg, interventions, steps, mem_steps, seed, engine))
+            print(f"{name:>10} x{scale:<4} {result['actors']:>7} actors: "
+                  f"populate {result['populate_s']:.3f}s, "
+                  f"{result['steps_per_sec']:.1f} steps/sec, "
+                  f"SimStats.step {result['stats_step_us']:.1f}us, "
+                  f"peak {result['peak_bytes'] / 2**20:.1f} MiB")
+            results.append(result)
+    return results
+
+
+def compare(old, new):
+    """
+    Prints, for every result that is in both old and new, how much faster
+    new is (>1 is faster) and its peak memory relative to old.
+    """
+    old_results = {(r['scenario'], r['scale']): r for r in old['results']}
+    for result in new['results']:
+        before = old_results.get((result['scenario'], result['scale']))
+        if before is None:
+            continue
+        print(f"{result['scenario']:>10} x{result['scale']:<4} "
+              f"populate {before['populate_s'] / result['populate_s']:.2f}x, "
+              f"steps/sec {result['steps_per_sec'] / before['steps_per_sec']:.2f}x, "
+              f"SimStats.step {before['stats_step_us'] / result['stats_step_us']:.2f}x, "
+              f"peak memory {result['peak_bytes'] / before['peak_bytes']:.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--mem-steps', type=int, default=20,
+                        help="steps to run while tracing memory")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=headless.ENGINES, default='object')
+    parser.add_argument('--sparse', action='store_true',
+                        help="store only occupied squares (see simulate.SparseGrid)")
+    parser.add_argument('--output', default=None, help="file to write the results to")
+    parser.add_argument('--compare', default=None, metavar='RESULTS',
+                        help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'engine': args.engine,
+        'sparse': args.sparse,
+        'steps': args.steps,
+        'seed': args.seed,
+        'results': run(args.scales, args.scenarios, args.steps, args.mem_steps,
+                       args.seed, args.engine, args.sparse),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return report
+
+
+if __name__ == '__main__':
+    main()
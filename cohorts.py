@@ -0,0 +1,292 @@
+"""
+Count-based mosquito engine.
+
+CohortSimulation keeps humans as individual Human actors, but stores
+mosquitos only as counts per grid cell. The counts are split by state
+(susceptible, infected or vaccinated) and by hunger, in whole steps. Every
+step, moving, biting, infection and death are drawn per cell and class as
+binomial and multinomial samples. The cost of a step therefore grows with
+the number of cells and humans instead of with the number of mosquitos.
+
+Bites go through Human.get_bitten_many: the biting mosquitos of one state
+in a cell bite together, as a cohort. The cohorts of a cell bite in a random
+order, so bites are not interleaved between mosquitos of different states
+within a step the way they are in Simulation. Hunger above the point where
+a mosquito always bites is kept in a single class (see HUNGER_MARGIN).
+"""
+import math
+
+import numpy as np
+
+from simulate import Simulation, Mosquito, neighbour_table
+
+
+# The states of a mosquito: the first axis of CohortSimulation.mosquitos.
+SUSCEPTIBLE, INFECTED, VACCINATED = range(3)
+# Hunger classes kept above the hunger at which a mosquito always bites. A
+# mosquito in the top class stays there, which only differs from Simulation
+# for mosquitos that lose this much hunger in a row.
+HUNGER_MARGIN = 30
+
+
+class Cohort:
+    """
+    Stands in for the mosquitos of one state that bite a human together
+    (see Human.get_bitten_many).
+    """
+    __slots__ = ('infected', 'vaccinated', 'config')
+
+    def __init__(self, state, config):
+        self.infected = state == INFECTED
+        self.vaccinated = state == VACCINATED
+        self.config = config
+
+
+class CohortSimulation(Simulation):
+    """
+    Represents a simulation in which mosquitos are counts per cell.
+
+    self.mosquitos has shape (3, hunger classes, cells). Hunger class i
+    holds the mosquitos with hunger min_hunger + i. The population of
+    mosquitos stays constant, as in Simulation. Draws are made with a NumPy
+    generator that is seeded from self.random.
+    """
+    def __init__(self, config, seed=None, fast_random=False, rng=None, populate=True,
+                 batch_deaths=True):
+        cfg = config.Mosquito
+        max_hunger = -cfg.fed_hunger
+        # Offsets of the hunger after a bite (see Mosquito.bite); the
+        # fraction of a step is dropped.
+        nut_range = cfg.fed_hunger - cfg.base_bite_nutrition
+        low = -cfg.base_bite_nutrition - max(nut_range, 0)
+        self.bite_offsets = np.arange(math.floor(low),
+                                      math.floor(low) + max(math.ceil(abs(nut_range)), 1))
+        always_bites = math.ceil(max_hunger / cfg.bite_chance)
+        self.min_hunger = min(cfg.fed_hunger, math.floor(low))
+        n_hunger = always_bites + HUNGER_MARGIN - self.min_hunger + 1
+        hunger = np.arange(n_hunger) + self.min_hunger
+        self.bite_chances = np.clip(cfg.bite_chance * hunger / max_hunger, 0, 1)
+
+        self.cohorts = [Cohort(state, cfg) for state in range(3)]
+        super().__init__(config, seed, fast_random, rng, populate=False,
+                         batch_deaths=batch_deaths)
+        self.np_random = np.random.default_rng(self.random.getrandbits(64))
+        x_max, y_max = self.grid.x_max, self.grid.y_max
+        self.neighbours = np.array(
+            neighbour_table(x_max, y_max, tuple(Mosquito.possible_moves)),
+            dtype=np.int64).reshape(x_max * y_max, -1)
+        self.mosquitos = np.zeros((3, n_hunger, x_max * y_max), dtype=np.int64)
+        if populate:
+            self.populate_grid()
+
+    def step(self):
+        self.t += 1
+        self.stats.step()
+
+        self.move_mosquitos()
+        self.bite()
+        self.feed_hunger()
+        dead_mosquitos = self.mosquito_deaths()
+
+        for actor in self.actors.copy():
+            actor.step()
+            actor.end_step()
+        if self.deaths:
+            deaths, self.deaths = self.deaths, []
+            self.handle_deaths(deaths)
+
+        self.respawn_mosquitos(dead_mosquitos)
+        self.update_counts()
+
+    def populate_mosquito(self):
+        """
+        Places config.Mosquito.n mosquitos like Simulation: the first on a
+        random square, every later one either on a random square or (when
+        clustering) on the square of a uniformly chosen earlier one.
+        """
+        cfg = self.config.Mosquito
+        n = cfg.n
+        if n:
+            rng = self.np_random
+            root = np.arange(n)
+            if cfg.cluster:
+                clustered = rng.random(n) < cfg.cluster_chance
+                clustered[0] = False
+                parents = (rng.random(n) * root).astype(np.int64)
+                root = np.where(clustered, parents, root)
+                while True:
+                    next_root = root[root]
+                    if np.array_equal(next_root, root):
+                        break
+                    root = next_root
+            squares = rng.integers(self.grid.n_cells, size=n)[root]
+            self.mosquitos[SUSCEPTIBLE, self.hunger_class(cfg.fed_hunger)] = np.bincount(
+                squares, minlength=self.grid.n_cells)
+            self.spawned_mosquitos = True
+        self.update_counts()
+
+    def hunger_class(self, hunger):
+        return min(max(hunger - self.min_hunger, 0), self.mosquitos.shape[1] - 1)
+
+    def sample(self, counts, p):
+        """
+        Returns a binomial sample of every count in counts with chance p
+        (a number, or an array of the shape of counts). Only the nonzero
+        counts are drawn for.
+        """
+        flat = counts.reshape(-1)
+        nonzero = np.flatnonzero(flat)
+        if not np.isscalar(p):
+            p = np.broadcast_to(p, counts.shape).reshape(-1)[nonzero]
+        sample = np.zeros_like(flat)
+        sample[nonzero] = self.np_random.binomial(flat[nonzero], p)
+        return sample.reshape(counts.shape)
+
+    def spread(self, counts, n_ways):
+        """
+        Splits every nonzero count in counts evenly at random over n_ways.
+        Returns the flat indices of those counts and their (n, n_ways)
+        shares.
+        """
+        flat = counts.reshape(-1)
+        nonzero = np.flatnonzero(flat)
+        return nonzero, self.np_random.multinomial(flat[nonzero], [1 / n_ways] * n_ways)
+
+    def move_mosquitos(self):
+        """
+        Moves every mosquito with move_chance to one of its neighbours;
+        moves that would leave the grid are not made.
+        """
+        m = self.mosquitos
+        movers = self.sample(m, self.config.Mosquito.move_chance)
+        m -= movers
+        n_moves = self.neighbours.shape[1]
+        index, moves = self.spread(movers, n_moves)
+        cells = index % self.grid.n_cells
+        targets = self.neighbours[cells]
+        targets = np.where(targets >= 0, (index - cells)[:, None] + targets, index[:, None])
+        m += np.bincount(targets.reshape(-1), weights=moves.reshape(-1),
+                         minlength=m.size).astype(m.dtype).reshape(m.shape)
+
+    def bite(self):
+        """
+        Draws the biting mosquitos of every square with a human. They bite
+        every human on their square, by state (see Human.get_bitten_many).
+        """
+        grid = self.grid
+        humans = {}
+        for human in self.actors:
+            humans.setdefault(grid.cell_of(human), []).append(human)
+        if not humans:
+            return
+        cells = np.fromiter(humans, dtype=np.int64, count=len(humans))
+        m = self.mosquitos
+        biters = self.sample(m[:, :, cells], self.bite_chances[None, :, None])
+        m[:, :, cells] -= biters
+
+        rng = self.np_random
+        totals = biters.sum(axis=1)
+        for j, cell in enumerate(humans):
+            if not totals[:, j].any():
+                continue
+            for human in humans[cell]:
+                for state in rng.permutation(3):
+                    n = biters[state, :, j].sum()
+                    if not n:
+                        continue
+                    infected = human.get_bitten_many(self.cohorts[state], int(n))
+                    if infected:
+                        moved = rng.multivariate_hypergeometric(biters[SUSCEPTIBLE, :, j],
+                                                                infected)
+                        biters[SUSCEPTIBLE, :, j] -= moved
+                        biters[INFECTED, :, j] += moved
+
+        for rounds in range(max(len(h) for h in humans.values())):
+            bitten = np.fromiter((len(h) > rounds for h in humans.values()), dtype=bool,
+                                 count=len(humans))
+            biters[:, :, bitten] = self.digest(biters[:, :, bitten])
+        m[:, :, cells] += biters
+
+    def digest(self, biters):
+        """ Returns the counts of biters moved to their hunger after a bite. """
+        n_states, n_hunger, n_cells = biters.shape
+        top = n_hunger - 1
+        index, shares = self.spread(biters, len(self.bite_offsets))
+        state, hunger, cell = np.unravel_index(index, biters.shape)
+        hunger = np.where(hunger[:, None] == top, top,
+                          np.clip(hunger[:, None] + self.bite_offsets, 0, top))
+        targets = (state[:, None] * n_hunger + hunger) * n_cells + cell[:, None]
+        return np.bincount(targets.reshape(-1), weights=shares.reshape(-1),
+                           minlength=biters.size).astype(biters.dtype).reshape(biters.shape)
+
+    def feed_hunger(self):
+        """ Makes every mosquito one step hungrier (see Hunger.step). """
+        m = self.mosquitos
+        m[:, -1] += m[:, -2]
+        m[:, 1:-1] = m[:, :-2]
+        m[:, 0] = 0
+
+    def mosquito_deaths(self):
+        """ Removes the mosquitos that die, and returns how many did. """
+        dead = self.sample(self.mosquitos, self.config.Mosquito.simple_death_chance)
+        self.mosquitos -= dead
+        return int(dead.sum())
+
+    def respawn_mosquitos(self, n):
+        """ Spawns n new mosquitos, like Simulation.new_mosquito. """
+        if not n:
+            return
+        cfg = self.config.Mosquito
+        rng = self.np_random
+        n_cells = self.grid.n_cells
+        per_cell = self.mosquitos.sum(axis=(0, 1))
+        total = per_cell.sum()
+
+        clustered = 0
+        if self.spawned_mosquitos and cfg.cluster and total:
+            clustered = rng.binomial(n, cfg.cluster_chance)
+        squares = rng.integers(n_cells, size=n - clustered)
+        if clustered:
+            squares = np.concatenate([squares, rng.choice(n_cells, size=clustered,
+                                                          p=per_cell / total)])
+        self.spawned_mosquitos = True
+
+        new = np.bincount(squares, minlength=n_cells)
+        fed = self.hunger_class(cfg.fed_hunger)
+        if self.vax_mosquitos:
+            vaccinated = rng.binomial(new, cfg.vax_rate)
+            self.mosquitos[VACCINATED, fed] += vaccinated
+            new -= vaccinated
+        self.mosquitos[SUSCEPTIBLE, fed] += new
+
+    def update_counts(self):
+        """ Sets the ActorCounts of mosquitos from self.mosquitos. """
+        per_state = self.mosquitos.sum(axis=(1, 2))
+        counts = self.counts['Mosquito']
+        counts.population = int(per_state.sum())
+        counts.infected = int(per_state[INFECTED])
+        counts.vaccinated = int(per_state[VACCINATED])
+        counts.immune = 0
+
+    def binomial(self, n, p):
+        return int(self.np_random.binomial(n, p))
+
+    def num_actors(self):
+        return len(self.actors) + self.counts['Mosquito'].population
+
+    def reseed(self, seed):
+        super().reseed(seed)
+        self.np_random = np.random.default_rng(self.random.getrandbits(64))
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['mosquito_counts'] = self.mosquitos.copy()
+        snapshot['np_random'] = self.np_random.bit_generator.state
+        return snapshot
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        self.mosquitos = snapshot['mosquito_counts'].copy()
+        self.np_random = np.random.default_rng()
+        self.np_random.bit_generator.state = snapshot['np_random']
+        self.update_counts()
@@ -45,3 +45,6 @@ class Human:
     
 class Grid:
     size = (40, 40)
+    # Store only occupied squares (see simulate.SparseGrid), for very
+    # large maps that are mostly empty.
+    sparse = False
@@ -0,0 +1,150 @@
+"""
+Stop conditions for headless runs.
+
+A Detector looks at the current SimStats values after every step and
+returns a reason when the run can stop: Extinction when no actor is
+infected any more, SteadyState when a stat has stopped changing, and
+Predicate for a condition of the caller. StopConditions combines them and
+remembers why and when the run stopped; pass it as headless.run(stop=...).
+
+When a run stops because of extinction, fast_forward() can fill in the
+stats series of the remaining steps.
+"""
+import collections
+import math
+
+
+class Detector:
+    """ Decides from the stats of a simulation whether the run can stop. """
+    def check(self, stats):
+        """ Returns the reason to stop as a string, or None. """
+        raise NotImplementedError
+
+
+class Extinction(Detector):
+    """
+    Stops when no human and no mosquito is infected. Nothing can infect an
+    actor again after that, so the run can't change its course.
+    """
+    def check(self, stats):
+        if not stats.infected_absolute('h') and not stats.infected_absolute('m'):
+            return "infection extinct"
+
+
+class SteadyState(Detector):
+    """
+    Stops when the standard deviation of a stat over the last window steps
+    is at most tolerance, e.g. at an endemic equilibrium.
+    """
+    def __init__(self, stat='infected_percentage', mode='h', window=200, tolerance=0.5):
+        self.stat, self.mode = stat, mode
+        self.window, self.tolerance = window, tolerance
+        self.values = collections.deque()
+        self.total = self.squares = 0.0
+
+    def check(self, stats):
+        value = getattr(stats, self.stat)(self.mode)
+        self.values.append(value)
+        self.total += value
+        self.squares += value * value
+        if len(self.values) > self.window:
+            old = self.values.popleft()
+            self.total -= old
+            self.squares -= old * old
+        if len(self.values) < self.window:
+            return None
+
+        mean = self.total / self.window
+        variance = max(self.squares / self.window - mean * mean, 0.0)
+        if math.sqrt(variance) <= self.tolerance:
+            # Recompute the sums, which drift over long runs, before stopping.
+            mean = math.fsum(self.values) / self.window
+            variance = math.fsum((v - mean) ** 2 for v in self.values) / self.window
+            if math.sqrt(variance) <= self.tolerance:
+                return (f"{self.stat}[{self.mode}] steady (std {math.sqrt(variance):.3g} "
+                        f"over {self.window} steps)")
+
+
+class Predicate(Detector):
+    """
+    Stops when expression, a Python expression, is true. It can use t and
+    the current value of every stat as <stat>_<mode>, for example
+    'infected_percentage_h < 1 and t > 500'.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self.code = compile(expression, '<stop condition>', 'eval')
+
+    def check(self, stats):
+        values = {'t': stats.sim.t}
+        for f_name, f in stats.stat_fns:
+            for m in f._modes:
+                values[f"{f_name}_{m}"] = f(m)
+        if eval(self.code, {'__builtins__': {}}, values):
+            return self.expression
+
+
+class StopConditions:
+    """
+    Checks detectors after every step, from min_steps on. Once one of them
+    fires, reason and t hold why and at which time the run stopped, and
+    detector holds the detector that fired.
+    """
+    def __init__(self, detectors, min_steps=0):
+        self.detectors = list(detectors)
+        self.min_steps = min_steps
+        self.reason = None
+        self.t = None
+        self.detector = None
+
+    def __call__(self, sim):
+        """ Returns the reason to stop after this step, or None. """
+        if sim.t < self.min_steps:
+            return None
+        for detector in self.detectors:
+            reason = detector.check(sim.stats)
+            if reason:
+                self.reason, self.t, self.detector = reason, sim.t, detector
+                return reason
+
+    def __bool__(self):
+        return bool(self.detectors)
+
+
+# Detectors by the name used in stop specs (see make_stop).
+DETECTORS = {
+    'extinct': Extinction,
+    'steady': SteadyState,
+    'if': Predicate,
+}
+
+
+def make_stop(specs, min_steps=0):
+    """
+    Returns StopConditions with a new detector per spec. A spec is a tuple
+    of a name in DETECTORS and the arguments of that detector, such as
+    ('steady', 'infected_percentage', 'h', 200, 0.5). Specs are plain data,
+    so they can be sent to worker processes.
+    """
+    return StopConditions([DETECTORS[name](*args) for name, *args in specs], min_steps)
+
+
+def fast_forward(sim, steps):
+    """
+    Runs sim on to time steps without stepping it, by extending every stats
+    series with the current values. Meant for runs that stopped because of
+    extinction: the population series are exact, as every death is
+    replaced, and the infection series stay at zero. The other series are
+    held at their current value, which leaves out the slow turnover of
+    immune and vaccinated humans. Returns the number of steps skipped.
+    """
+    skipped = max(steps - sim.t, 0)
+    stats = sim.stats
+    for f_name, f in stats.stat_fns:
+        for m in f._modes:
+            value = f(m)
+            series = stats.data[f_name][m]
+            for _ in range(skipped):
+                series.append(value)
+    sim.t += skipped
+    return skipped
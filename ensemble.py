@@ -0,0 +1,216 @@
+"""
+Streaming aggregation of the stats of many runs.
+
+Ensemble.add takes the SimStats series of one run (see SimStats.get_state)
+and merges them into running per-step aggregates: the mean and variance
+(Welford's method), the minimum and maximum, and a histogram with a fixed
+number of bins from which quantiles are read. The memory used grows with
+the number of steps and bins, not with the number of runs, so the series of
+a run can be dropped as soon as it has been added.
+
+band() returns the confidence band of a stat per step, and plot_panels()
+draws the bands like SimStats.plot_panels.
+"""
+import math
+import statistics
+from array import array
+
+
+# Bins of the quantile histogram of every stat, mode and step.
+N_BINS = 64
+# Stats that are not percentages are counts of actors, which are binned up
+# to this many times the largest population of the first run.
+HEADROOM = 1.5
+
+
+class Accumulator:
+    """
+    Running per-step aggregates of one stat and mode over runs. Values
+    outside lo to hi are counted in the first or last bin, so their
+    quantiles are only bounded by the minimum and maximum of the step.
+    """
+    def __init__(self, lo, hi, n_bins=N_BINS):
+        self.lo, self.hi, self.n_bins = lo, hi, n_bins
+        self.width = (hi - lo) / n_bins
+        self.count = array('l')
+        self.mean = array('d')
+        self.m2 = array('d')
+        self.min = array('d')
+        self.max = array('d')
+        # n_bins counts per step.
+        self.hist = array('l')
+
+    def __len__(self):
+        return len(self.count)
+
+    def grow(self, n):
+        """ Makes room for the steps of a run of n steps. """
+        extra = n - len(self.count)
+        if extra <= 0:
+            return
+        for values in (self.count, self.mean, self.m2):
+            values.frombytes(bytes(extra * values.itemsize))
+        self.min.extend([math.inf] * extra)
+        self.max.extend([-math.inf] * extra)
+        self.hist.frombytes(bytes(extra * self.n_bins * self.hist.itemsize))
+
+    def add(self, values):
+        """ Merges the series of one run. """
+        self.grow(len(values))
+        count, mean, m2 = self.count, self.mean, self.m2
+        lo, width, top = self.lo, self.width, self.n_bins - 1
+        for t, x in enumerate(values):
+            k = count[t] + 1
+            count[t] = k
+            delta = x - mean[t]
+            mean[t] += delta / k
+            m2[t] += delta * (x - mean[t])
+            if x < self.min[t]:
+                self.min[t] = x
+            if x > self.max[t]:
+                self.max[t] = x
+            b = min(max(int((x - lo) / width), 0), top)
+            self.hist[t * self.n_bins + b] += 1
+
+    def variance(self):
+        """ Returns the sample variance per step (0 for a single run). """
+        return array('d', (m2 / (k - 1) if k > 1 else 0.0
+                           for k, m2 in zip(self.count, self.m2)))
+
+    def quantile(self, q):
+        """
+        Returns the q-quantile per step, interpolated within its histogram
+        bin and clamped to the minimum and maximum of the step.
+        """
+        n_bins = self.n_bins
+        result = array('d')
+        for t, k in enumerate(self.count):
+            target = q * k
+            seen = 0
+            row = t * n_bins
+            for b in range(n_bins):
+                n = self.hist[row + b]
+                if n and seen + n >= target:
+                    value = self.lo + self.width * (b + (target - seen) / n)
+                    break
+                seen += n
+            else:
+                value = self.max[t]
+            result.append(min(max(value, self.min[t]), self.max[t]))
+        return result
+
+
+class Ensemble:
+    """
+    Aggregates the SimStats series of many runs per stat, mode and step.
+
+    Runs can have different lengths (e.g. when stopped early without
+    fast-forwarding, see convergence.py); the aggregates of a step then
+    only cover the runs that reached it, as count() tells.
+    """
+    def __init__(self, n_bins=N_BINS, ranges=None):
+        self.n_bins = n_bins
+        # Maps a stat to the (lo, hi) of its histogram; see default_range.
+        self.ranges = dict(ranges or {})
+        self.accumulators = {}
+        self.n_runs = 0
+
+    def default_range(self, stat, m, data):
+        if stat.endswith('_percentage'):
+            return 0.0, 100.0
+        population = data['population'][m]
+        return 0.0, max(HEADROOM * max(population, default=0), 1.0)
+
+    def add(self, data):
+        """ Merges the series of a run, as returned by SimStats.get_state. """
+        for stat, modes in data.items():
+            for m, values in modes.items():
+                acc = self.accumulators.get((stat, m))
+                if acc is None:
+                    lo, hi = self.ranges.get(stat) or self.default_range(stat, m, data)
+                    acc = self.accumulators[stat, m] = Accumulator(lo, hi, self.n_bins)
+                acc.add(values)
+        self.n_runs += 1
+
+    def columns(self):
+        return list(self.accumulators)
+
+    def count(self, stat, m):
+        """ Returns the number of runs that reached every step. """
+        return self.accumulators[stat, m].count[:]
+
+    def mean(self, stat, m):
+        return self.accumulators[stat, m].mean[:]
+
+    def variance(self, stat, m):
+        return self.accumulators[stat, m].variance()
+
+    def std(self, stat, m):
+        return array('d', map(math.sqrt, self.variance(stat, m)))
+
+    def minimum(self, stat, m):
+        return self.accumulators[stat, m].min[:]
+
+    def maximum(self, stat, m):
+        return self.accumulators[stat, m].max[:]
+
+    def quantile(self, stat, m, q):
+        return self.accumulators[stat, m].quantile(q)
+
+    def band(self, stat, m, level=0.9, kind='quantile'):
+        """
+        Returns the low, middle and high series of a band that holds level
+        of the runs per step. kind 'quantile' gives the central quantiles of
+        the runs around their median; kind 'mean' gives the normal
+        confidence interval of the mean around the mean.
+        """
+        if kind == 'quantile':
+            tail = (1 - level) / 2
+            return (self.quantile(stat, m, tail), self.quantile(stat, m, 0.5),
+                    self.quantile(stat, m, 1 - tail))
+        if kind != 'mean':
+            raise ValueError(f"Unknown band kind '{kind}'")
+        z = statistics.NormalDist().inv_cdf((1 + level) / 2)
+        mean = self.mean(stat, m)
+        errors = [z * math.sqrt(var / k) for var, k in
+                  zip(self.variance(stat, m), self.count(stat, m))]
+        return (array('d', (x - e for x, e in zip(mean, errors))), mean,
+                array('d', (x + e for x, e in zip(mean, errors))))
+
+    def summary(self, level=0.9):
+        """
+        Returns the aggregates as a dict mapping '<stat>[<mode>]' to a dict
+        of lists per step, for writing as JSON.
+        """
+        tail = (1 - level) / 2
+        summary = {}
+        for stat, m in self.accumulators:
+            summary[f"{stat}[{m}]"] = {
+                'count': self.count(stat, m).tolist(),
+                'mean': self.mean(stat, m).tolist(),
+                'std': self.std(stat, m).tolist(),
+                'min': self.minimum(stat, m).tolist(),
+                'max': self.maximum(stat, m).tolist(),
+                f'q{tail:g}': self.quantile(stat, m, tail).tolist(),
+                'median': self.quantile(stat, m, 0.5).tolist(),
+                f'q{1 - tail:g}': self.quantile(stat, m, 1 - tail).tolist(),
+            }
+        return summary
+
+    def plot(self, stat, mode, t_start=0, t_end=None, level=0.9, kind='quantile',
+             save_fig=False, show=True):
+        """ Plots the bands of stat for every mode in mode (see plot_panels). """
+        return self.plot_panels([(stat, mode)], t_start, t_end, level, kind, save_fig, show)
+
+    def plot_panels(self, panels, t_start=0, t_end=None, level=0.9, kind='quantile',
+                    save_fig=False, show=True):
+        """
+        Plots a figure with a panel per (stat, mode) pair, with a band per
+        mode (see band), in a background process (see plotting.plot_bands),
+        and returns the process.
+        """
+        import plotting
+
+        bands = {(stat, m): self.band(stat, m, level, kind)
+                 for stat, mode in panels for m in mode}
+        return plotting.plot_bands(bands, panels, t_start, t_end, save_fig, show)
@@ -0,0 +1,235 @@
+"""
+Per-square frame summaries, and a worker that steps a simulation in a
+background thread and hands out frames of it.
+
+A frame is what the GUI needs to draw one step: the time, one summary
+word per grid square and the sidebar values. The summary of a square packs
+the flags the GUI colours it by (see encode_square), so frames can be
+copied, compared and stored without touching the actors.
+"""
+import collections
+import queue
+import threading
+import time
+from array import array
+
+
+# Bits of a square summary.
+HUMAN = 1 << 0
+HUMAN_INFECTED = 1 << 1
+HUMAN_IMMUNE = 1 << 2
+HUMAN_VACCINATED = 1 << 3
+HUMAN_NET = 1 << 4
+MOSQUITO = 1 << 5
+MOSQUITO_VACCINATED = 1 << 6
+# The number of infected mosquitos, capped at MAX_INFECTED, is stored in
+# the bits above MOSQUITO_INFECTED_SHIFT.
+MOSQUITO_INFECTED_SHIFT = 7
+MAX_INFECTED = 7
+
+HUMAN_FLAGS = (
+    ('infected', HUMAN_INFECTED),
+    ('immune', HUMAN_IMMUNE),
+    ('vaccinated', HUMAN_VACCINATED),
+    ('use_net', HUMAN_NET),
+)
+
+
+Frame = collections.namedtuple('Frame', 't squares stats profile', defaults=((),))
+Frame.__doc__ = """
+One frame of a simulation: the time, an array('H') with the summary of
+every square (indexed by cell id), a list of (label, text) pairs for the
+sidebar and, when profiling, a list of (phase, ms per step) pairs.
+"""
+
+
+def encode_square(grid, cell, human_cls, mosquito_cls):
+    """ Returns the summary word of a cell of grid. """
+    word = 0
+    for human in grid.actors_in(cell, human_cls):
+        word |= HUMAN
+        for flag, bit in HUMAN_FLAGS:
+            if getattr(human, flag):
+                word |= bit
+
+    if grid.counts[mosquito_cls][cell]:
+        word |= MOSQUITO
+        if grid.vaccinated[mosquito_cls][cell]:
+            word |= MOSQUITO_VACCINATED
+        infected = min(grid.infected[mosquito_cls][cell], MAX_INFECTED)
+        word |= infected << MOSQUITO_INFECTED_SHIFT
+    return word
+
+
+def mosquitos_infected(word):
+    return word >> MOSQUITO_INFECTED_SHIFT
+
+
+class SquareSummary:
+    """
+    Keeps the summary words of all squares of a grid up to date, by
+    re-encoding only the cells the grid reports as dirty. Turns on dirty
+    tracking for the grid. After update(), self.changed holds the cells it
+    re-encoded.
+    """
+    def __init__(self, grid, human_cls, mosquito_cls):
+        self.grid = grid
+        self.human_cls = human_cls
+        self.mosquito_cls = mosquito_cls
+        self.squares = array('H', [0]) * grid.n_cells
+        grid.track_dirty()
+        self.update(range(grid.n_cells))
+
+    def update(self, cells=None):
+        """ Re-encodes cells, by default the cells that changed. """
+        if cells is None:
+            cells = self.grid.take_dirty()
+        self.changed = cells
+        for cell in cells:
+            self.squares[cell] = encode_square(self.grid, cell, self.human_cls,
+                                               self.mosquito_cls)
+        return self.squares
+
+
+# The human stats shown in the sidebar, as (label, SimStats method).
+HUMAN_STATS = (
+    ("Human inf.rate", 'infected_percentage'),
+    ("Acquired resistance", 'resistance_percentage'),
+    ("Human vax.rate", 'vaccinated_percentage'),
+)
+
+
+def describe_sim(sim):
+    """
+    Returns the time, the number of actors and the human stats of sim as
+    (label, text) pairs, as they are stored in recordings.
+    """
+    stats = [("Time", f"{sim.t}"), ("Actors", f"{sim.num_actors()}")]
+    for label, name in HUMAN_STATS:
+        stats.append((label, f"{getattr(sim.stats, name)('h'):.2f}"))
+    return stats
+
+
+def changed_cells(old, new):
+    """ Returns the cells whose summary differs between two frames. """
+    if old is None or len(old) != len(new):
+        return range(len(new))
+    return [cell for cell, (a, b) in enumerate(zip(old, new)) if a != b]
+
+
+class SimWorker(threading.Thread):
+    """
+    Steps a simulation in a background thread.
+
+    Other threads control it by sending commands (see the do_* methods) and
+    read self.frame, the most recent frame it published; call publish() once
+    before starting the worker to have a first frame. A frame is only
+    built when one was requested, and the worker never waits for a frame to
+    be drawn, so a slow reader skips frames instead of slowing down the
+    simulation.
+
+    The worker steps continuously while running, pausing step_delay seconds
+    after each step; with a step_delay of 0 it runs at full speed. Anything
+    that uses the simulation directly from another thread must hold
+    self.lock.
+
+    With a recorder (see recording.FrameRecorder), every step is recorded;
+    call record() once before starting the worker to record the first state.
+    """
+    min_delay = 0.0001
+
+    def __init__(self, sim, human_cls, mosquito_cls, describe=None, step_delay=0.0,
+                 profiler=None, recorder=None):
+        super().__init__(daemon=True)
+        self.sim = sim
+        self.describe = describe
+        self.profiler = profiler
+        self.recorder = recorder
+        self.step_delay = step_delay
+        self.running = False
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.commands = queue.Queue()
+
+        self.summary = SquareSummary(sim.grid, human_cls, mosquito_cls)
+        self.steps_per_second = 0.0
+        self._rate_t, self._rate_time = sim.t, time.perf_counter()
+        self.frame = None
+        self.frame_id = 0
+
+    def run(self):
+        while not self.stopped:
+            self.handle_commands(block=not self.running)
+            if self.running and not self.stopped:
+                with self.lock:
+                    self.step()
+                if self.step_delay:
+                    time.sleep(self.step_delay)
+
+    def handle_commands(self, block):
+        while True:
+            try:
+                name, args = self.commands.get(block=block)
+            except queue.Empty:
+                return
+            with self.lock:
+                getattr(self, 'do_' + name)(*args)
+            block = False
+
+    def send(self, name, *args):
+        self.commands.put((name, args))
+
+    def step(self):
+        self.sim.step()
+        self.record()
+
+    def record(self):
+        """ Records the current state, if the worker has a recorder. """
+        if self.recorder:
+            squares = self.summary.update()
+            self.recorder.record(self.sim.t, squares, describe_sim(self.sim),
+                                 self.summary.changed)
+
+    def publish(self):
+        """ Builds a frame of the current state and makes it self.frame. """
+        now = time.perf_counter()
+        if now > self._rate_time:
+            self.steps_per_second = (self.sim.t - self._rate_t) / (now - self._rate_time)
+        self._rate_t, self._rate_time = self.sim.t, now
+
+        stats = self.describe(self) if self.describe else []
+        profile = ()
+        if self.profiler:
+            profile = [(phase.name, phase.ms_per_step) for phase in self.profiler.report()]
+        self.frame = Frame(self.sim.t, array('H', self.summary.update()), stats, profile)
+        self.frame_id += 1
+
+    # Commands, run in the worker thread.
+
+    def do_frame(self):
+        self.publish()
+
+    def do_step(self):
+        self.step()
+        self.publish()
+
+    def do_toggle_running(self):
+        self.running = not self.running
+
+    def do_set(self, name, value):
+        setattr(self.sim, name, value)
+
+    def do_faster(self):
+        self.step_delay = self.step_delay / 2 if self.step_delay >= 2*self.min_delay else 0.0
+
+    def do_slower(self):
+        self.step_delay = max(self.step_delay * 2, self.min_delay)
+
+    def do_stop(self):
+        self.stopped = True
+
+    def stop(self):
+        """ Stops the worker and waits for it to finish. """
+        self.send('stop')
+        if self.is_alive():
+            self.join()
@@ -1,5 +1,7 @@
 import curses
-from simulate import Simulation, Human, Mosquito
+import frames
+import profiling
+import recording
 import config
 import importlib
 import os
@@ -14,8 +16,12 @@ class ResetException(Exception):
 
 
 class Gui:
-    def __init__(self, config):
+    def __init__(self, config, rng=None, profile=False, record=None, size=None):
         self.config = config
+        self.rng = rng
+        self.profiler = profiling.Profiler() if profile else None
+        self.record = record
+        self.size = size or config.Grid.size
         self.stdscr = curses.initscr()
         if not curses.has_colors():
             raise RuntimeError("Your terminal must support colors!")
@@ -55,14 +61,14 @@ class Gui:
         
         self.running = True
         self.n = 0
-        self.step_delay = 0.0025
-        self.frameskip = 0
+        self.fps = 30
+        self.frame = None
         
     def verify_screen_size(self):
         """ Verifies that the terminal we are running in is large enough. """
         height, width = self.stdscr.getmaxyx()
         
-        grid_x, grid_y = self.config.Grid.size
+        grid_x, grid_y = self.size
     
         required_x = 2*grid_x + 24 # sidebar
         required_y = grid_y + 2
@@ -79,15 +85,28 @@ class Gui:
             raise SystemExit
         
     def init_sim(self):
+        from simulate import Simulation, Human, Mosquito
+
         self.stdscr.addstr(0, 0, "Initialising simulation...")
         self.stdscr.noutrefresh(); curses.doupdate()
         
-        self.sim = Simulation(config)
+        if self.profiler:
+            self.profiler.enable()
+        self.sim = Simulation(config, rng=self.rng)
+        if self.profiler:
+            self.profiler.reset()
+        recorder = None
+        if self.record:
+            recorder = recording.FrameRecorder(self.record, self.size)
+        self.worker = frames.SimWorker(self.sim, Human, Mosquito,
+                                       describe=self.describe, step_delay=0.0025,
+                                       profiler=self.profiler, recorder=recorder)
+        self.requested = 0
         
         self.stats = {
             "Time": self.get_info(self.sim, "t"),
-            "Step delay": self.get_info(self, "step_delay"),
-            "Frameskip": self.get_info(self, "frameskip"),
+            "Step delay": self.get_info(self.worker, "step_delay"),
+            "Steps/s": self.get_info(self.worker, "steps_per_second", trunc=True),
             "Actors": self.get_info(self.sim, "num_actors", func=True,),
             "Human inf.rate": self.get_info(self.sim.stats, "infected_percentage", ['h'], True, True),
             "Acquired resistance": self.get_info(self.sim.stats, "resistance_percentage", ['h'], True, True),
@@ -101,17 +120,46 @@ class Gui:
             def info():
                 return getattr(obj, name)
             return info, args, trunc
+
+    def describe(self, worker):
+        """
+        Returns the sidebar values as (label, text) pairs. Called by the
+        worker when it builds a frame.
+        """
+        stats = []
+        for k, (f, args, trunc) in self.stats.items():
+            val = f(*args)
+            stats.append((k, f"{val:.2f}" if trunc else f"{val}"))
+        return stats
         
     def run(self):
+        """
+        Starts the worker and draws its latest frame fps times per second,
+        handling key presses in between.
+        """
         self.init_sim()
         try:
             self.draw_border()
-            self.draw()
+            self.worker.record()
+            self.worker.publish()
+            self.draw(full=True)
+            self.worker.start()
+            next_frame = time.perf_counter()
             while self.running:
+                wait = next_frame - time.perf_counter()
+                self.stdscr.timeout(max(0, int(wait * 1000)))
                 self.handle_input()
+                if time.perf_counter() >= next_frame:
+                    self.draw()
+                    next_frame = max(next_frame + 1 / self.fps, time.perf_counter())
         except curses.error:
             self.verify_screen_size()
         finally:
+            self.worker.stop()
+            if self.worker.recorder:
+                self.worker.recorder.close()
+            if self.profiler:
+                self.profiler.disable()
             self.cleanup()
         
     def cleanup(self):
@@ -122,91 +170,89 @@ class Gui:
             
     def handle_input(self):
         c = self.stdscr.getch()
+        worker = self.worker
         
-        if c == ord('n'):
-            self.sim.step()
-            self.draw()
+        if c == ord('n') and not worker.running:
+            worker.send('step')
             
         if c == ord('c'):
-            self.stdscr.nodelay(True)
+            worker.send('toggle_running')
             
-            mod = 1
+        if c == ord('+'):
+            worker.send('faster')
             
-            while True:
-                time.sleep(self.step_delay)
-                ch = self.stdscr.getch()
-                if (ch == ord('c')):
-                    break
-                elif (ch == ord('+')):
-                    self.step_delay /= 2
-                elif (ch == ord('-')):
-                    self.step_delay *= 2
-                elif (ch == ord(',')):
-                    self.frameskip = max(0, self.frameskip - 1)
-                elif (ch == ord('.')):
-                    self.frameskip += 1
-                elif (ch == ord('v')):
-                    self.sim.vax_mosquitos = True
-                elif (ch == ord('k')):
-                    self.sim.use_net = True
-                    
-                self.sim.step()
-                if (self.sim.t % (1 + self.frameskip) == 0):
-                    self.draw()
-                self.stdscr.refresh()
-            self.stdscr.nodelay(False)
+        if c == ord('-'):
+            worker.send('slower')
+            
+        if c == ord(','):
+            self.fps = max(1, self.fps - 5)
+            
+        if c == ord('.'):
+            self.fps += 5
+            
+        if c == ord('v'):
+            worker.send('set', 'vax_mosquitos', True)
+            
+        if c == ord('k'):
+            worker.send('set', 'use_net', True)
             
         if c == ord('q'):
             self.running = False
+
+        if c == curses.KEY_RESIZE:
+            self.redraw()
             
         if c == ord('r'):
             raise ResetException()
             
-        if c == ord('v'):
-            self.sim.vax_mosquitos = True
-            
         if c == ord('p'):
-            self.plot_plots()
+            with worker.lock:
+                self.plot_plots()
     
     def plot_plots(self):
-        self.sim.stats.plot("population", "mh", save_fig=True)
-        self.sim.stats.plot("infected_percentage", "mh", save_fig=True)
-        self.sim.stats.plot("resistance_percentage", "h", save_fig=True)
-        self.sim.stats.plot("vaccinated_percentage", "h", save_fig=True)
+        self.sim.stats.plot_panels([
+            ("population", "mh"),
+            ("infected_percentage", "mh"),
+            ("resistance_percentage", "h"),
+            ("vaccinated_percentage", "h"),
+        ], save_fig=True)
     
     def draw_border(self):
-        for x in range(2*self.sim.grid.x_max + 21):
-            if x == 2*self.sim.grid.x_max:
+        for x in range(2*self.size[0] + 21):
+            if x == 2*self.size[0]:
                 continue
             self.put(0, x + 1, "═")
-            self.put(self.sim.grid.y_max + 1, x + 1, "═")
-        for y in range(self.sim.grid.y_max):
+            self.put(self.size[1] + 1, x + 1, "═")
+        for y in range(self.size[1]):
             self.put(y + 1, 0, "║")
-            self.put(y + 1, 2*self.sim.grid.x_max + 1, "║")
-            self.put(y + 1, 2*self.sim.grid.x_max + 22, "║")
+            self.put(y + 1, 2*self.size[0] + 1, "║")
+            self.put(y + 1, 2*self.size[0] + 22, "║")
         self.put(0, 0, "╔")
-        self.put(0, 2*self.sim.grid.x_max + 1, "╦")
-        self.put(self.sim.grid.y_max + 1, 0, "╚")
-        self.put(self.sim.grid.y_max + 1, 2*self.sim.grid.x_max + 1, "╩")
-        self.put(0, 2*self.sim.grid.x_max + 22, "╗")
-        self.put(self.sim.grid.y_max + 1, 2*self.sim.grid.x_max + 22, "╝")
+        self.put(0, 2*self.size[0] + 1, "╦")
+        self.put(self.size[1] + 1, 0, "╚")
+        self.put(self.size[1] + 1, 2*self.size[0] + 1, "╩")
+        self.put(0, 2*self.size[0] + 22, "╗")
+        self.put(self.size[1] + 1, 2*self.size[0] + 22, "╝")
         self.put(0, 2, "Simulation:")
-        self.put(0, 2*self.sim.grid.x_max + 3, "Statistics:")
+        self.put(0, 2*self.size[0] + 3, "Statistics:")
         
-    def draw_stats(self):
-        x_off = 2*self.sim.grid.x_max + 2
-        for i, (k, (f, args, trunc)) in enumerate(self.stats.items()):
+    def draw_stats(self, stats):
+        x_off = 2*self.size[0] + 2
+        for i, (k, val) in enumerate(stats):
             self.put(1 + i*3, x_off, f"{k}:")
-            if args:
-                val = f(*args)
-            else:
-                val = f()
-            if trunc:
-                self.put(2 + i*3, x_off, f"{val:.2f}")
-            else:
-                self.put(2 + i*3, x_off, f"{val}")
+            self.put(2 + i*3, x_off, val)
             self.stdscr.clrtoeol()
             self.put(3 + i*3, x_off - 1, "╠════════════════════╣")
+
+    def draw_profile(self, y_off, profile):
+        """ Draws the slowest phases of a step (in ms/step) from row y_off. """
+        x_off = 2*self.size[0] + 2
+        rows = self.size[1] + 1 - y_off
+        if rows < 2:
+            return
+        self.put(y_off, x_off, "Profile (ms/step):")
+        for i, (name, ms) in enumerate(profile[:rows - 1]):
+            self.put(y_off + 1 + i, x_off, f"{name[:13]:<13}{ms:>7.2f}")
         
     def put(self, y, x, str, *args):
         self.stdscr.addstr(y, x, str.encode('utf-8'), *args)
@@ -215,81 +261,187 @@ class Gui:
         for i in range(1, curses.COLORS):
             curses.init_pair(i, i, bgcolor)
         
-    def draw(self):
-        self.draw_stats()
-        
-        x_max, y_max = self.sim.grid.x_max, self.sim.grid.y_max
-        for x in range(x_max):
-            for y in range(y_max):
-                COLOR_BASE = 0
-                if (x % 2 == y % 2):
-                    COLOR_BASE = 128
-                    
-                square = self.sim.grid[x, y]
-                
-                has_human = False
-                has_mosquitos = False
-                mosquito_infected = 0
-                human_infected = False
-                human_immune = False
-                human_vaccinated = False
-                human_use_net = False
-                mosquito_vaccinated = False
-
-                for actor in square:
-                    if actor.is_mosquito():
-                        has_mosquitos = True
-                        if actor.infected:
-                            mosquito_infected += 1
-                        if actor.vaccinated:
-                            mosquito_vaccinated = True
-                    if actor.is_human():
-                        has_human = True
-                        if actor.infected:
-                            human_infected = True
-                        if actor.immune:
-                            human_immune = True
-                        if actor.vaccinated:
-                            human_vaccinated = True
-                        if actor.use_net:
-                            human_use_net = True
-                        
-                color = curses.color_pair(COLOR_BASE)
-                        
-                if human_infected:
-                    color = curses.color_pair(COLOR_BASE + 7)
-                    
-                if human_vaccinated:
-                    color = curses.color_pair(COLOR_BASE + 2)
-                    
-                if human_immune:
-                    color = curses.color_pair(COLOR_BASE + 8)
-                    
-                if human_use_net:
-                    color = curses.color_pair(COLOR_BASE + 15)
-                    
-                self.put(y + 1, x*2 + 1, "H" if has_human else " ", color)
-                
-                args = [y + 1, x*2 + 2, "•" if has_mosquitos else " "]
-                
-                colors = [0, 9, 10, 11, 12, 13, 14]
-                
-                if mosquito_infected > 6:
-                    mosquito_infected = 6
-                    
-                
-                    
-                color_pair = curses.color_pair(COLOR_BASE + colors[mosquito_infected])
-                
-                if mosquito_vaccinated:
-                    color_pair = curses.color_pair(COLOR_BASE + 2)
-                args.append(color_pair)
-                
-                self.put(*args)
-                
+    def redraw(self):
+        """ Repaints the whole screen, e.g. after the terminal was resized. """
+        self.verify_screen_size()
+        self.stdscr.clear()
+        self.draw_border()
+        self.draw(full=True)
+
+    def draw(self, full=False):
+        """
+        Draws the worker's latest frame, then asks the worker for the next
+        frame.
+        """
+        worker = self.worker
+        self.draw_frame(worker.frame, full)
+        if worker.frame_id >= self.requested:
+            worker.send('frame')
+            self.requested = worker.frame_id + 1
+
+    def draw_frame(self, frame, full=False, extra_stats=()):
+        """
+        Draws the stats of a frame and the squares that changed since the
+        previously drawn frame, or every square if full is set.
+        """
+        if frame is not self.frame or full:
+            stats = list(frame.stats) + list(extra_stats)
+            self.draw_stats(stats)
+            if frame.profile:
+                self.draw_profile(1 + 3*len(stats), frame.profile)
+            old = None if full or self.frame is None else self.frame.squares
+            for cell in frames.changed_cells(old, frame.squares):
+                self.draw_square(cell, frame.squares[cell])
+            self.frame = frame
+            self.stdscr.refresh()
+
+    def draw_square(self, cell, word):
+        x, y = divmod(cell, self.size[1])
+
+        COLOR_BASE = 0
+        if (x % 2 == y % 2):
+            COLOR_BASE = 128
+
+        color = curses.color_pair(COLOR_BASE)
+
+        if word & frames.HUMAN_INFECTED:
+            color = curses.color_pair(COLOR_BASE + 7)
+
+        if word & frames.HUMAN_VACCINATED:
+            color = curses.color_pair(COLOR_BASE + 2)
+
+        if word & frames.HUMAN_IMMUNE:
+            color = curses.color_pair(COLOR_BASE + 8)
+
+        if word & frames.HUMAN_NET:
+            color = curses.color_pair(COLOR_BASE + 15)
+
+        self.put(y + 1, x*2 + 1, "H" if word & frames.HUMAN else " ", color)
+
+        args = [y + 1, x*2 + 2, "•" if word & frames.MOSQUITO else " "]
+
+        colors = [0, 9, 10, 11, 12, 13, 14]
+
+        mosquito_infected = frames.mosquitos_infected(word)
+        if mosquito_infected > 6:
+            mosquito_infected = 6
+
+        color_pair = curses.color_pair(COLOR_BASE + colors[mosquito_infected])
+
+        if word & frames.MOSQUITO_VACCINATED:
+            color_pair = curses.color_pair(COLOR_BASE + 2)
+        args.append(color_pair)
+
+        self.put(*args)
+
+
+class ReplayGui(Gui):
+    """
+    Plays back a recording made with --record (see recording.FrameFile),
+    without running a simulation. Playback can be paused, reversed and
+    moved to any recorded step.
+
+    Keys: c plays/pauses, b reverses, n/right and left step, PgUp/PgDn jump
+    100 steps, Home/End and 0-9 seek, +/- change the playback speed.
+    """
+    def __init__(self, path):
+        self.recording = recording.FrameFile(path)
+        if not len(self.recording):
+            raise SystemExit(f"{path} holds no frames")
+        super().__init__(config, size=self.recording.size)
+        self.index = 0
+        self.playing = False
+        self.direction = 1
+        self.speed = 1
+
+    def run(self):
+        try:
+            self.draw_border()
+            self.draw(full=True)
+            next_frame = time.perf_counter()
+            while self.running:
+                wait = next_frame - time.perf_counter()
+                self.stdscr.timeout(max(0, int(wait * 1000)))
+                self.handle_input()
+                if time.perf_counter() >= next_frame:
+                    if self.playing:
+                        self.seek(self.index + self.direction * self.speed)
+                    self.draw()
+                    next_frame = max(next_frame + 1 / self.fps, time.perf_counter())
+        except curses.error:
+            self.verify_screen_size()
+        finally:
+            self.recording.close()
+            self.cleanup()
+
+    def seek(self, index):
+        """ Moves to a recorded step, stopping playback at either end. """
+        last = len(self.recording) - 1
+        if not 0 <= index <= last:
+            self.playing = False
+        self.index = min(max(index, 0), last)
+
+    def handle_input(self):
+        c = self.stdscr.getch()
+
+        if c == ord('c'):
+            self.playing = not self.playing
+
+        if c == ord('b'):
+            self.direction = -self.direction
+
+        if c in (ord('n'), curses.KEY_RIGHT):
+            self.seek(self.index + 1)
+
+        if c == curses.KEY_LEFT:
+            self.seek(self.index - 1)
+
+        if c == curses.KEY_NPAGE:
+            self.seek(self.index + 100)
+
+        if c == curses.KEY_PPAGE:
+            self.seek(self.index - 100)
+
+        if c == curses.KEY_HOME:
+            self.seek(0)
+
+        if c == curses.KEY_END:
+            self.seek(len(self.recording) - 1)
+
+        # 0-9 jump to 0%-90% of the recording.
+        if ord('0') <= c <= ord('9'):
+            self.seek((c - ord('0')) * len(self.recording) // 10)
+
+        if c == ord('+'):
+            self.speed *= 2
+
+        if c == ord('-'):
+            self.speed = max(1, self.speed // 2)
+
+        if c == ord(','):
+            self.fps = max(1, self.fps - 5)
+
+        if c == ord('.'):
+            self.fps += 5
+
+        if c == ord('q'):
+            self.running = False
+
+        if c == curses.KEY_RESIZE:
+            self.redraw()
+
+    def draw(self, full=False):
+        frame = self.recording.frame(self.index)
+        state = "playing" if self.playing else "paused"
+        arrow = ">" if self.direction > 0 else "<"
+        self.draw_frame(frame, full, [
+            ("Frame", f"{self.index + 1}/{len(self.recording)}"),
+            ("Replay", f"{state} {arrow} x{self.speed}"),
+        ])
+
 
 def print_required_terminal_size(gui):
-    grid_x, grid_y = gui.sim.config.Grid.size
+    grid_x, grid_y = gui.size
     
     current_y, current_x = gui.stdscr.getmaxyx()
     
@@ -302,14 +454,16 @@ def print_required_terminal_size(gui):
     print(f"Your current terminal size is: {current_x} columns, "
           f"{current_y} lines.")
     
-def gui_loop():
+def gui_loop(rng=None, profile=False, record=None):
     global config
     while True:
         try:
-            g = Gui(config)
+            g = Gui(config, rng, profile, record)
             g.run()
         except ResetException:
             config = importlib.reload(config)
+            # A reset starts a new run, with a fresh generator.
+            rng = None
         except curses.error:
             print_required_terminal_size(g)
             break
@@ -317,21 +471,34 @@ def gui_loop():
             break
 
 if __name__ == '__main__':
-    args = sys.argv
-    # Save/load the random state to generate deterministic runs.
+    # Save/load the simulation's initial random state to generate
+    # deterministic runs. --seed S seeds the simulation directly.
+    rng = random.Random()
     state = None
     for n, i in enumerate(sys.argv):
         if i == '--set-state':
             fname = sys.argv[n+1]
             with open(fname, 'rb') as f:
                 state = pickle.load(f)
-                random.setstate(state)
+                rng.setstate(state)
+        if i == '--seed':
+            rng.seed(int(sys.argv[n+1]))
+            state = rng.getstate()
+    # --profile shows the time spent in every phase of a step in the sidebar.
+    profile = '--profile' in sys.argv
+    # --record FILE records every step to a frame file, which --replay FILE
+    # plays back.
+    record = None
+    for n, i in enumerate(sys.argv):
+        if i == '--record':
+            record = sys.argv[n+1]
+        if i == '--replay':
+            ReplayGui(sys.argv[n+1]).run()
+            sys.exit()
     if not state:
         # Only save the random state if we haven't just loaded one,
         # as we don't really need to duplicate it.
-        state = random.getstate()
+        state = rng.getstate()
         with open(time.strftime("%d%m-%H%M%S.randomstate"), 'wb') as f:
             pickle.dump(state, f)
-    gui_loop()
-    
-    
\ No newline at end of file
+    gui_loop(rng, profile, record)
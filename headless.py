@@ -0,0 +1,268 @@
+"""
+Headless batch runner for simulations.
+
+Runs a simulation at full speed, without curses or matplotlib, prints the
+speed and the final stats and writes the stats time series to disk:
+
+    python -m simulate run --steps 1000 --seed 1 --config config \
+        --vax-at 500 --net-at 500 --output run.csv
+
+With --profile it also prints how much time every phase of a step took
+(see profiling.Profiler). With --record it records every step to a frame
+file that gui.py --replay plays back. --stop-extinct, --stop-steady and
+--stop-if end a run early (see convergence.py).
+"""
+import argparse
+import importlib
+import time
+
+import convergence
+import frames
+import profiling
+import recording
+import simulate
+
+# Interventions that can be switched on during a run, and the simulation
+# flags they set. These are the switches the GUI toggles with 'v' and 'k'.
+INTERVENTIONS = {
+    'vax': 'vax_mosquitos',
+    'net': 'use_net',
+}
+
+ENGINES = ('object', 'vector', 'tiled', 'event', 'cohort')
+
+
+def make_simulation(config, seed=None, engine='object', fast_random=False, tiles=(2, 2),
+                    batch_deaths=True):
+    if engine == 'vector':
+        from vectorized import VectorSimulation
+        return VectorSimulation(config, seed=seed)
+    if engine == 'tiled':
+        from tiled import TiledSimulation
+        return TiledSimulation(config, tiles, seed=seed, fast_random=fast_random)
+    if engine == 'event':
+        from scheduled import EventSimulation
+        return EventSimulation(config, seed=seed, fast_random=fast_random,
+                               batch_deaths=batch_deaths)
+    if engine == 'cohort':
+        from cohorts import CohortSimulation
+        return CohortSimulation(config, seed=seed, fast_random=fast_random,
+                                batch_deaths=batch_deaths)
+
+    return simulate.Simulation(config, seed=seed, fast_random=fast_random,
+                               batch_deaths=batch_deaths)
+
+
+def run(sim, steps, interventions=(), after_step=None, stop=None):
+    """
+    Steps sim steps times. interventions is an iterable of (t, name) pairs:
+    intervention name is switched on for every step after time t.
+    after_step, if given, is called with sim after every step. stop, if
+    given, is called with sim after every step (see
+    convergence.StopConditions); the run ends early once it returns a
+    reason.
+    """
+    pending = sorted(interventions)
+    for _ in range(steps):
+        while pending and pending[0][0] <= sim.t:
+            setattr(sim, INTERVENTIONS[pending.pop(0)[1]], True)
+        sim.step()
+        if after_step:
+            after_step(sim)
+        if stop and stop(sim):
+            break
+    return sim
+
+
+def make_recorder(sim, path):
+    """
+    Returns a function that records the state of sim to a frame file (see
+    recording.FrameRecorder), and the recorder to close when done.
+    """
+    summary = frames.SquareSummary(sim.grid, simulate.Human, simulate.Mosquito)
+    recorder = recording.FrameRecorder(path, (sim.grid.x_max, sim.grid.y_max))
+
+    def record(sim):
+        squares = summary.update()
+        recorder.record(sim.t, squares, frames.describe_sim(sim), summary.changed)
+    return record, recorder
+
+
+def close(sim):
+    """ Stops the worker processes of a tiled simulation. """
+    if hasattr(sim, 'close'):
+        sim.close()
+
+
+def parse_tiles(text):
+    """ Parses 'COLSxROWS' into a tuple of ints. """
+    return tuple(int(n) for n in text.lower().split('x', 1))
+
+
+def final_stats(stats):
+    """ Returns a dict mapping (stat, mode) to the stat's current value. """
+    values = {}
+    for f_name, f in stats.stat_fns:
+        for m in f._modes:
+            try:
+                values[f_name, m] = f(m)
+            except ZeroDivisionError:
+                values[f_name, m] = float('nan')
+    return values
+
+
+def parse_intervention(name):
+    def parse(t):
+        return int(t), name
+    return parse
+
+
+def add_intervention_arguments(parser):
+    for name in INTERVENTIONS:
+        parser.add_argument(f'--{name}-at', type=parse_intervention(name),
+                            dest='interventions', action='append',
+                            default=[], metavar='T',
+                            help=f"switch on {INTERVENTIONS[name]} at time T")
+
+
+def parse_stat(text):
+    """ Parses 'stat[mode]' into a stat name and a mode. """
+    name, mode = text.rstrip(']').split('[', 1)
+    return name, mode
+
+
+def add_stop_arguments(parser):
+    parser.add_argument('--stop-extinct', action='store_true',
+                        help="stop once no human or mosquito is infected")
+    parser.add_argument('--stop-steady', type=parse_stat, nargs='?', default=None,
+                        const=('infected_percentage', 'h'), metavar='STAT[MODE]',
+                        help="stop once STAT[MODE] (default infected_percentage[h]) "
+                             "is steady; see --steady-window and --steady-tolerance")
+    parser.add_argument('--steady-window', type=int, default=200, metavar='N')
+    parser.add_argument('--steady-tolerance', type=float, default=0.5, metavar='STD')
+    parser.add_argument('--stop-if', default=None, metavar='EXPR',
+                        help="stop once EXPR is true, e.g. 'infected_percentage_h < 1'")
+    parser.add_argument('--min-steps', type=int, default=0,
+                        help="don't stop early before this many steps")
+    parser.add_argument('--fast-forward', action='store_true',
+                        help="after extinction, fill in the stats of the remaining "
+                             "steps instead of running them")
+
+
+def stop_specs(args):
+    """ Returns the stop specs (see convergence.make_stop) of the arguments. """
+    specs = []
+    if args.stop_extinct:
+        specs.append(('extinct',))
+    if args.stop_steady:
+        specs.append(('steady', *args.stop_steady, args.steady_window,
+                      args.steady_tolerance))
+    if args.stop_if:
+        specs.append(('if', args.stop_if))
+    return tuple(specs)
+
+
+def finish_early(sim, stop, steps, fast_forward=False):
+    """
+    Fast-forwards sim to steps if fast_forward is set and it stopped
+    because of extinction. Returns the number of steps skipped.
+    """
+    if fast_forward and isinstance(stop.detector, convergence.Extinction):
+        return convergence.fast_forward(sim, steps)
+    return 0
+
+
+def build_parser():
+    import sweep
+
+    parser = argparse.ArgumentParser(prog='python -m simulate')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run a simulation headless")
+    run_parser.add_argument('--steps', type=int, default=1000)
+    run_parser.add_argument('--seed', type=int, default=None)
+    run_parser.add_argument('--config', default='config',
+                            help="module to read the configuration from")
+    run_parser.add_argument('--engine', choices=ENGINES, default='object')
+    run_parser.add_argument('--fast-random', action='store_true',
+                            help="draw random numbers in pre-drawn blocks")
+    run_parser.add_argument('--immediate-deaths', dest='batch_deaths', action='store_false',
+                            help="handle every death as soon as it happens, "
+                                 "reproducing runs from before deaths were batched")
+    run_parser.add_argument('--tiles', type=parse_tiles, default=(2, 2), metavar='COLSxROWS',
+                            help="tile layout of the tiled engine, one process per tile")
+    run_parser.add_argument('--output', default='stats.csv',
+                            help="file (.csv) or directory (.npz chunks) to "
+                                 "write the stats time series to")
+    run_parser.add_argument('--dump-every', type=int, default=None, metavar='N',
+                            help="flush the time series to --output every N steps")
+    run_parser.add_argument('--profile', action='store_true',
+                            help="time the phases of every step and print a report")
+    run_parser.add_argument('--record', default=None, metavar='FILE',
+                            help="record every step to a frame file, to replay "
+                                 "with gui.py --replay FILE (object and event engines)")
+    add_intervention_arguments(run_parser)
+    add_stop_arguments(run_parser)
+
+    sweep_parser = commands.add_parser(
+        'sweep', help="run many headless simulations in worker processes")
+    sweep.add_arguments(sweep_parser)
+    add_intervention_arguments(sweep_parser)
+    add_stop_arguments(sweep_parser)
+    sweep_parser.set_defaults(main=sweep.main)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command != 'run':
+        return args.main(args)
+    if args.record and args.engine not in ('object', 'event'):
+        parser.error("--record needs the object or event engine")
+
+    config = importlib.import_module(args.config)
+
+    profiler = profiling.Profiler(args.engine).enable() if args.profile else None
+    start = time.perf_counter()
+    sim = make_simulation(config, args.seed, args.engine, args.fast_random, args.tiles,
+                          args.batch_deaths)
+    if profiler:
+        profiler.reset()
+    if args.output:
+        sim.stats.dump(args.output, every=args.dump_every)
+    record, recorder = make_recorder(sim, args.record) if args.record else (None, None)
+    if record:
+        record(sim)
+    stop = convergence.make_stop(stop_specs(args), args.min_steps)
+    populated = time.perf_counter()
+    run(sim, args.steps, args.interventions, record, stop)
+    finished = time.perf_counter()
+    steps_run = sim.t
+    skipped = finish_early(sim, stop, args.steps, args.fast_forward)
+    close(sim)
+    if recorder:
+        recorder.close()
+        print(f"Recorded {recorder.n_frames} frames to {args.record}")
+
+    print(f"Populated {sim.num_actors()} actors in {populated - start:.2f}s")
+    print(f"Ran {steps_run} steps in {finished - populated:.2f}s "
+          f"({steps_run / (finished - populated):.1f} steps/sec)")
+    if stop.reason:
+        print(f"Stopped at t={stop.t} ({stop.reason})")
+    if skipped:
+        print(f"Fast-forwarded {skipped} steps to t={sim.t}")
+    for (f_name, m), value in final_stats(sim.stats).items():
+        print(f"{f_name}[{m}]: {value:.2f}")
+
+    if profiler:
+        profiler.disable()
+        print(profiler.format_report())
+
+    if args.output:
+        sim.stats.dump()
+        print(f"Wrote stats to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
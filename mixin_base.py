@@ -1,52 +1,132 @@
-import functools
-import inspect
-import random
+
+def _empty(*a, **k):
+    pass
+
+def _empty_documented(*a, **k):
+    """ Does nothing. """
+
+EMPTY_CODE = {_empty.__code__.co_code, _empty_documented.__code__.co_code}
+
+def is_empty(fn):
+    """ Returns whether fn is a function whose body does nothing. """
+    code = getattr(fn, '__code__', None)
+    return code is not None and code.co_code in EMPTY_CODE
+
+def unique_nonempty(fns):
+    """ Returns a tuple of the non-empty functions in fns, without duplicates. """
+    plan = []
+    for fn in fns:
+        if fn is not None and not is_empty(fn) and fn not in plan:
+            plan.append(fn)
+    return tuple(plan)
 
 class MixinMeta(type):
+    """
+    Metaclass for mixins. Defines empty step/end_step methods, and gives
+    every class that does not declare __slots__ itself the slots for all
+    _fields declared by its bases, so actors built from mixins get a compact
+    layout without a __dict__. Mixins declare their attributes in _fields and
+    use an empty __slots__, so they can be combined freely.
+    """
     define_empties = ['step', 'end_step']
     def __new__(metacls, name, bases, dct):
         for empty in metacls.define_empties:
             if empty not in dct:
                 dct[empty] = lambda *a, **k: None
+        if '__slots__' not in dct:
+            dct['__slots__'] = slots_for(bases, dct.get('_fields', ()))
         return super().__new__(metacls, name, bases, dct)
 
+def slots_for(bases, fields=()):
+    """
+    Returns the _fields declared by bases (and fields) that are not already
+    slots of one of the bases.
+    """
+    declared, taken = [], set()
+    for base in bases:
+        for supercls in base.mro():
+            declared.extend(supercls.__dict__.get('_fields', ()))
+            taken.update(supercls.__dict__.get('__slots__', ()))
+    declared.extend(fields)
+    return tuple(dict.fromkeys(f for f in declared if f not in taken))
+
 class MixinBase(metaclass=MixinMeta):
+    """
+    Base class for mixins. Constructing an instance runs the __init__ of every
+    class in its MRO, and all_super_step/all_super_end_step run the step and
+    end_step of every superclass.
+
+    The functions to call are compiled once per class into flat tuples
+    (_init_plan, _step_plan and _end_step_plan), leaving out duplicates and
+    functions that do nothing.
+    """
+    __slots__ = ()
+
     def __init__(self, *a, **k):
-        self.all_supers = AllSuperProxy(self)
+        pass
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
-        
-        old_init = getattr(cls, '__init__', lambda *a, **b: None)
-        
+
+        cls._own_init = cls.__dict__.get('__init__')
+
         def new_init(self, *a, **kwa):
-            if type(self) == cls:
-                # We are the most derived type.
-                for supercls in cls.mro()[1:]:
-                    supercls.__init__(self, *a, **kwa)
-                    
-                    if (supercls == MixinBase):
-                        break
-            
-            old_init(self, *a, **kwa)
-            
-        cls._step_mro = cls.mro()[1:-2]
+            for init in type(self)._init_plan:
+                init(self, *a, **kwa)
+
+        mro = cls.mro()
+        supers = mro[1:mro.index(MixinBase) + 1]
+        cls._init_plan = unique_nonempty(
+            [own_init(supercls) for supercls in supers] + [own_init(cls)])
+
+        cls._step_mro = mro[1:-2]
+        cls._step_plan = unique_nonempty(supercls.step for supercls in cls._step_mro)
+        cls._end_step_plan = unique_nonempty(supercls.end_step for supercls in cls._step_mro)
+        cls._supermethods = {}
         cls.__init__ = new_init
-    
+
+    @property
+    def all_supers(self):
+        return AllSuperProxy(self)
+
     def all_super_step(self, *args, **kwargs):
-        for cls in self._step_mro:
-            cls.step(self, *args, **kwargs)
-            
+        for step in self._step_plan:
+            step(self, *args, **kwargs)
+
     def all_super_end_step(self, *args, **kwargs):
-        for cls in self._step_mro:
-            cls.end_step(self, *args, **kwargs)
+        for end_step in self._end_step_plan:
+            end_step(self, *args, **kwargs)
+
+def own_init(cls):
+    """
+    Returns the __init__ that was defined in the body of cls, or of the
+    closest class in its MRO that defined one.
+    """
+    for supercls in cls.mro():
+        if '_own_init' in supercls.__dict__:
+            if supercls._own_init is not None:
+                return supercls._own_init
+        elif '__init__' in supercls.__dict__:
+            return supercls.__dict__['__init__']
+
+def supermethods(cls, f_name):
+    """
+    Returns the f_name methods of all superclasses of cls, cached on the class.
+    """
+    cache = cls.__dict__.get('_supermethods')
+    if cache is None or f_name not in cache:
+        methods = tuple(getattr(supercls, f_name) for supercls in cls.mro()[1:]
+                        if hasattr(supercls, f_name))
+        if cache is None:
+            return methods
+        cache[f_name] = methods
+    return cache[f_name]
 
 class AllSuperProxy:
     def __init__(self, obj):
         self.cls = type(obj)
         self.obj = obj
-    
-    @functools.lru_cache()
+
     def __getattr__(self, f_name):
         return MultiFnProxy(self.obj, self.cls.mro()[1:], f_name)
 
@@ -55,14 +135,7 @@ class MultiFnProxy:
         self.obj = obj
         self.superclasses = superclasses
         self.f_name = f_name
-        
-        self.supermethods = []
-        for superclass in self.superclasses:
-            try:
-                self.supermethods.append(getattr(superclass, f_name))
-            except AttributeError:
-                pass
-        
-        
+        self.supermethods = supermethods(type(obj), f_name)
+
     def __call__(self, *args, **kwargs):
-        return [supermethod(self.obj, *args, **kwargs) for supermethod in self.supermethods]
\ No newline at end of file
+        return [supermethod(self.obj, *args, **kwargs) for supermethod in self.supermethods]
@@ -1,50 +1,81 @@
 from mixin_base import MixinBase
-from event import Event
-import random
+
+def counted_flag(name):
+    """
+    Returns a property for a boolean actor flag that notifies the simulation
+    (once the actor has been spawned) whenever the flag changes, so it can
+    keep its counts up to date.
+    """
+    attr = '_' + name
+
+    def get(self):
+        return getattr(self, attr)
+
+    def set(self, value):
+        old = getattr(self, attr)
+        setattr(self, attr, value)
+        if value != old and self.counts is not None:
+            self.sim.flag_changed(self, name, 1 if value else -1)
+
+    return property(get, set)
 
 class Infectable(MixinBase):
     """
     Mixin that keeps track of an actor's infection status,
     and allows other actors to infect the actor.
     """
+    __slots__ = ()
+    _fields = ('_infected', 'infection_count', 'infection_time', '_immune',
+               '_vaccinated', 'use_net')
+
+    infected = counted_flag('infected')
+    immune = counted_flag('immune')
+    vaccinated = counted_flag('vaccinated')
+
     def __init__(self, sim, config, *args, **kwargs):
-        self.infected = False
+        self._infected = False
         self.infection_count = 0
         self.infection_time = 0
-        self.immune = False
-        self.vaccinated = False
+        self._immune = False
+        self._vaccinated = False
         self.use_net = False
 
-    def infect(self):
+    def infect(self, times=1):
+        """ Infects the actor, counting times infections. """
         if self.vaccinated:
             return
         if not self.infected:
             self.infection_time = self.sim.t
         self.infected = True
-        self.infection_count += 1
+        self.infection_count += times
 
 class Death(MixinBase):
     """
-    Mixin that keeps track of an actor's death status. Also contains
-    an event allowing other objects to hook the actor's death.
+    Mixin that keeps track of an actor's death status. Dead actors are
+    reported to the simulation (see Simulation.died).
     """
+    __slots__ = ()
+    _fields = ('age', '_dead')
+
     def __init__(self, *a, **kwa):
         self.age = 0
         self._dead = False
-        self.on_death = Event('on_death')
-        self.on_death.hook(self.sim.handle_death)
 
     def end_step(self):
         if self._dead:
-            self.on_death.fire(self)
+            self.sim.died(self)
 
 class NaturalDeath(Death):
     """
+    Mixin that represents death by old age: the chance to die grows with
+    every timestep the actor lives.
     """
+    __slots__ = ()
+
     def step(self):
         die_chance = self.age * self.config.age_death_factor + self.config.death_base
 
-        if random.random() < die_chance:
+        if self.sim.random.random() < die_chance:
             self._dead = True
 
         self.age += 1
@@ -55,8 +86,10 @@ class SimpleDeath(Death):
     Mixin that represents 'simple' death, i.e. a single chance
     which is checked every timestep that determines whether an actor dies.
     """
+    __slots__ = ()
+
     def step(self):
-        if random.random() < self.config.simple_death_chance:
+        if self.sim.random.random() < self.config.simple_death_chance:
             self._dead = True
 
 
@@ -64,6 +97,8 @@ class MalariaDeath(Death):
     """
     Mixin that represents death by malaria.
     """
+    __slots__ = ()
+
     def __init__(self, *a, **kwa):
         pass
 
@@ -72,11 +107,14 @@ class MalariaDeath(Death):
             return
 
         dur_fac = (self.sim.t - self.infection_time) / 10000
-        if not self.immune and random.random() < self.config.malaria_death_chance + dur_fac:
+        if not self.immune and self.sim.random.random() < self.config.malaria_death_chance + dur_fac:
             self._dead = True
 
 class Hunger(MixinBase):
     """ Mixin that keeps track of an actor's hunger. """
+    __slots__ = ()
+    _fields = ('hunger',)
+
     def __init__(self, sim, config, *args, **kwargs):
         T = type(self)
         self.hunger = self.config.fed_hunger
@@ -95,13 +133,16 @@ class Actor:
 
     To test whether an Actor is of a certain subclass, call Actor.is_<subclass>.
     """
+    __slots__ = ()
+    _fields = ('sim', 'global_config', 'config', 'counts')
+
     def __init__(self, sim, config, *rest, **kwa):
-        self.args = (sim, config, *rest)
         self.sim, self.global_config = sim, config
+        self.counts = None
         self.config = getattr(self.global_config, type(self).__name__)
 
     def __repr__(self):
-        return f"{type(self).__name__}({self.args})"
+        return f"{type(self).__name__}({self.sim}, {self.global_config})"
 
     def step(self):
         """ Override to perform tasks at the start of a timestep. """
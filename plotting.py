@@ -0,0 +1,161 @@
+"""
+Plots of SimStats series, drawn in a background process.
+
+SimStats.plot hands a copy of the requested series to a new process, which
+downsamples them and draws them as one figure with a panel per stat. The
+caller doesn't wait for the figure, and doesn't import matplotlib itself.
+Ensemble.plot does the same for the bands of many runs (see ensemble.py).
+"""
+import multiprocessing
+import os
+
+
+# Series longer than twice this are downsampled to a minimum and a maximum
+# per bucket, which keeps the peaks that plain decimation would drop.
+MAX_BUCKETS = 2000
+
+
+def min_max(values, t_start=0, n_buckets=MAX_BUCKETS):
+    """
+    Downsamples a series that starts at time t_start. Splits it into
+    n_buckets buckets and keeps the smallest and the largest value of each,
+    in time order. Returns the times and the values.
+    """
+    n = len(values)
+    if n <= 2 * n_buckets:
+        return list(range(t_start, t_start + n)), list(values)
+
+    times, kept = [], []
+    for b in range(n_buckets):
+        lo, hi = b * n // n_buckets, (b + 1) * n // n_buckets
+        bucket = values[lo:hi]
+        low, high = min(bucket), max(bucket)
+        i_low, i_high = bucket.index(low), bucket.index(high)
+        for i in sorted({i_low, i_high}):
+            times.append(t_start + lo + i)
+            kept.append(bucket[i])
+    return times, kept
+
+
+def envelope(low, mid, high, t_start=0, n_buckets=MAX_BUCKETS):
+    """
+    Downsamples a band to n_buckets buckets: the lowest low, the mean of
+    mid and the highest high of every bucket, at the bucket's first time.
+    Returns the times and the three series.
+    """
+    n = len(mid)
+    if n <= 2 * n_buckets:
+        return list(range(t_start, t_start + n)), list(low), list(mid), list(high)
+
+    times, lows, mids, highs = [], [], [], []
+    for b in range(n_buckets):
+        lo, hi = b * n // n_buckets, (b + 1) * n // n_buckets
+        times.append(t_start + lo)
+        lows.append(min(low[lo:hi]))
+        mids.append(sum(mid[lo:hi]) / (hi - lo))
+        highs.append(max(high[lo:hi]))
+    return times, lows, mids, highs
+
+
+def fig_path(panels, t_start, t_end, prefix='plot'):
+    name = '+'.join(f"{stat}_{mode}" for stat, mode in panels)
+    return os.path.join('plots', f"{prefix}_{name}_{t_start}-{t_end}.png")
+
+
+def figure(panels, show):
+    """ Returns a figure and a column of axes, one per panel. """
+    import matplotlib
+    if not show:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(len(panels), 1, sharex=True, squeeze=False,
+                             figsize=(8, 2.5 * len(panels)))
+    return fig, axes[:, 0]
+
+
+def finish(fig, axes, path, show):
+    """ Saves fig to path (unless it is None), then shows it if show is set. """
+    import matplotlib.pyplot as plt
+
+    axes[-1].set_xlabel('time')
+    fig.tight_layout()
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fig.savefig(path)
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def draw(panels, series, t_start, t_end, save_fig, show):
+    """
+    Draws one figure with a panel per (stat, mode) in panels, from series
+    mapping (stat, m) to its values from t_start. Saves it under plots/ if
+    save_fig is set, then shows it if show is set.
+    """
+    fig, axes = figure(panels, show)
+    for ax, (stat, mode) in zip(axes, panels):
+        for m in mode:
+            ax.plot(*min_max(series[stat, m], t_start))
+        ax.set_ylabel(stat)
+        ax.legend(mode)
+    finish(fig, axes, save_fig and fig_path(panels, t_start, t_end), show)
+
+
+def draw_bands(panels, bands, t_start, t_end, save_fig, show):
+    """
+    Like draw, but bands maps (stat, m) to the low, middle and high series
+    of a band (see ensemble.Ensemble.band), drawn as a line and a shaded
+    area.
+    """
+    fig, axes = figure(panels, show)
+    for ax, (stat, mode) in zip(axes, panels):
+        for m in mode:
+            times, low, mid, high = envelope(*bands[stat, m], t_start)
+            line, = ax.plot(times, mid, label=m)
+            ax.fill_between(times, low, high, color=line.get_color(), alpha=0.25)
+        ax.set_ylabel(stat)
+        ax.legend()
+    finish(fig, axes, save_fig and fig_path(panels, t_start, t_end, 'bands'), show)
+
+
+def start(target, args):
+    """ Starts a process that runs target(*args), and returns it. """
+    # Spawned rather than forked, as the caller may be running threads.
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=target, args=args)
+    process.start()
+    return process
+
+
+def plot(data, panels, t_start=0, t_end=None, save_fig=False, show=True):
+    """
+    Starts a process that draws the (stat, mode) panels of data (as in
+    SimStats.data) for times t_start to t_end, and returns it. Only the
+    requested part of the series is copied to the process.
+    """
+    series = {}
+    for stat, mode in panels:
+        for m in mode:
+            values = data[stat][m]
+            end = len(values) if t_end is None else t_end
+            series[stat, m] = values[t_start:end]
+    if t_end is None:
+        t_end = t_start + max((len(values) for values in series.values()), default=0)
+    return start(draw, (panels, series, t_start, t_end, save_fig, show))
+
+
+def plot_bands(bands, panels, t_start=0, t_end=None, save_fig=False, show=True):
+    """
+    Starts a process that draws the bands of the (stat, mode) panels (see
+    draw_bands) for times t_start to t_end, and returns it.
+    """
+    series = {}
+    for stat, mode in panels:
+        for m in mode:
+            end = len(bands[stat, m][1]) if t_end is None else t_end
+            series[stat, m] = tuple(values[t_start:end] for values in bands[stat, m])
+    if t_end is None:
+        t_end = t_start + max((len(band[1]) for band in series.values()), default=0)
+    return start(draw_bands, (panels, series, t_start, t_end, save_fig, show))
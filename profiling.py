@@ -0,0 +1,200 @@
+"""
+Optional per-phase profiling of the step loop.
+
+A Profiler wraps the methods that make up a step (moving, biting, death
+handling, placing new humans, recording stats and the step/end_step of
+every mixin) with timers that record call counts and cumulative time.
+The methods are only replaced while the profiler is enabled, so a run
+without profiling executes exactly the same code as before:
+
+    profiler = Profiler()
+    with profiler:
+        sim = Simulation(config)
+        profiler.reset()
+        for _ in range(100):
+            sim.step()
+    print(profiler.format_report())
+
+Enable the profiler before creating the simulation: the simulation hooks
+its handle_death to on_death when it is created. Times are inclusive, so
+Mosquito.step includes the time of Mosquito.move and Mosquito.bite.
+The wrappers are installed on the classes, so they time every simulation
+in the process.
+"""
+import collections
+import functools
+import importlib
+import time
+
+
+# (module, class, method) of the phases to time, per engine. The first phase
+# of an engine is its step, which counts the steps.
+PHASES = {
+    'object': [
+        ('simulate', 'Simulation', 'step'),
+        ('stats', 'SimStats', 'step'),
+        ('simulate', 'Human', 'step'),
+        ('simulate', 'Human', 'end_step'),
+        ('simulate', 'Human', 'get_bitten'),
+        ('simulate', 'Mosquito', 'step'),
+        ('simulate', 'Mosquito', 'end_step'),
+        ('simulate', 'Mosquito', 'move'),
+        ('simulate', 'Mosquito', 'bite'),
+        ('simulate', 'Simulation', 'handle_death'),
+        ('simulate', 'Simulation', 'handle_deaths'),
+        ('simulate', 'Simulation', 'new_human'),
+        ('simulate', 'Simulation', 'new_mosquito'),
+    ],
+    'vector': [
+        ('vectorized', 'VectorSimulation', 'step'),
+        ('stats', 'SimStats', 'step'),
+        ('vectorized', 'VectorSimulation', 'move_mosquitos'),
+        ('vectorized', 'VectorSimulation', 'bite'),
+        ('vectorized', 'VectorSimulation', 'mosquito_deaths'),
+        ('vectorized', 'VectorSimulation', 'human_step'),
+        ('vectorized', 'VectorSimulation', 'respawn_mosquitos'),
+        ('vectorized', 'VectorSimulation', 'respawn_humans'),
+    ],
+    # The tiles step in their own processes, so only the parent is timed.
+    'tiled': [
+        ('tiled', 'TiledSimulation', 'step'),
+        ('stats', 'SimStats', 'step'),
+    ],
+    'event': [
+        ('scheduled', 'EventSimulation', 'step'),
+        ('stats', 'SimStats', 'step'),
+        ('scheduled', 'EventSimulation', 'on_move'),
+        ('scheduled', 'EventSimulation', 'on_bite'),
+        ('scheduled', 'EventSimulation', 'on_resist'),
+        ('scheduled', 'EventSimulation', 'on_natural_death'),
+        ('scheduled', 'EventSimulation', 'on_malaria_death'),
+        ('scheduled', 'EventSimulation', 'on_mosquito_death'),
+        ('simulate', 'Mosquito', 'move'),
+        ('simulate', 'Mosquito', 'bite'),
+        ('scheduled', 'EventSimulation', 'handle_deaths'),
+        ('simulate', 'Simulation', 'new_human'),
+        ('simulate', 'Simulation', 'new_mosquito'),
+    ],
+    'cohort': [
+        ('cohorts', 'CohortSimulation', 'step'),
+        ('stats', 'SimStats', 'step'),
+        ('cohorts', 'CohortSimulation', 'move_mosquitos'),
+        ('cohorts', 'CohortSimulation', 'bite'),
+        ('simulate', 'Human', 'get_bitten_many'),
+        ('cohorts', 'CohortSimulation', 'digest'),
+        ('cohorts', 'CohortSimulation', 'feed_hunger'),
+        ('cohorts', 'CohortSimulation', 'mosquito_deaths'),
+        ('simulate', 'Human', 'step'),
+        ('simulate', 'Human', 'end_step'),
+        ('cohorts', 'CohortSimulation', 'handle_deaths'),
+        ('cohorts', 'CohortSimulation', 'respawn_mosquitos'),
+    ],
+}
+
+# Classes whose compiled mixin plans (see MixinBase) are timed per function.
+PLAN_CLASSES = {
+    'object': [('simulate', 'Human'), ('simulate', 'Mosquito')],
+    'vector': [],
+    'tiled': [],
+    'event': [],
+    'cohort': [('simulate', 'Human')],
+}
+PLANS = ('_step_plan', '_end_step_plan')
+
+
+PhaseStats = collections.namedtuple('PhaseStats', 'name calls seconds calls_per_step ms_per_step')
+
+
+def timed(fn, record):
+    """
+    Returns a wrapper around fn that adds 1 to record[0] and the time the
+    call took to record[1].
+    """
+    perf_counter = time.perf_counter
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record[0] += 1
+            record[1] += perf_counter() - start
+    return wrapper
+
+
+class Profiler:
+    """
+    Records call counts and cumulative time of the phases of a step, while
+    enabled. Can be used as a context manager.
+    """
+    def __init__(self, engine='object'):
+        self.engine = engine
+        self.records = collections.defaultdict(lambda: [0, 0.0])
+        self.step_name = None
+        self._patched = []
+
+    @property
+    def enabled(self):
+        return bool(self._patched)
+
+    def enable(self):
+        if self.enabled:
+            return self
+        for module, cls_name, attr in PHASES[self.engine]:
+            cls = getattr(importlib.import_module(module), cls_name)
+            name = f"{cls_name}.{attr}"
+            if self.step_name is None:
+                self.step_name = name
+            self._patch(cls, attr, timed(getattr(cls, attr), self.records[name]))
+
+        for module, cls_name in PLAN_CLASSES[self.engine]:
+            cls = getattr(importlib.import_module(module), cls_name)
+            for plan in PLANS:
+                self._patch(cls, plan, tuple(timed(fn, self.records[fn.__qualname__])
+                                             for fn in getattr(cls, plan)))
+        return self
+
+    def _patch(self, owner, attr, value):
+        self._patched.append((owner, attr, owner.__dict__.get(attr)))
+        setattr(owner, attr, value)
+
+    def disable(self):
+        """ Puts the original methods back. """
+        for owner, attr, original in reversed(self._patched):
+            if original is None:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, original)
+        self._patched = []
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def reset(self):
+        """ Forgets everything recorded so far, e.g. the population phase. """
+        for record in self.records.values():
+            record[:] = [0, 0.0]
+
+    @property
+    def steps(self):
+        return self.records[self.step_name][0] if self.step_name else 0
+
+    def report(self):
+        """
+        Returns a PhaseStats for every phase that was called, slowest first.
+        """
+        steps = max(self.steps, 1)
+        phases = [PhaseStats(name, calls, seconds, calls / steps, 1000 * seconds / steps)
+                  for name, (calls, seconds) in self.records.items() if calls]
+        return sorted(phases, key=lambda phase: -phase.seconds)
+
+    def format_report(self):
+        lines = [f"{'phase':<34}{'calls':>10}{'calls/step':>12}{'ms/step':>10}{'total s':>10}"]
+        for phase in self.report():
+            lines.append(f"{phase.name:<34}{phase.calls:>10}{phase.calls_per_step:>12.1f}"
+                         f"{phase.ms_per_step:>10.3f}{phase.seconds:>10.3f}")
+        return '\n'.join(lines)
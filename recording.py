@@ -0,0 +1,191 @@
+"""
+Compact recordings of the per-square frame summaries of a run.
+
+A frame file starts with a header holding the grid size, followed by one
+record per recorded step. A record is either a keyframe, holding the
+summary word (see frames.encode_square) of every square, or a delta,
+holding the cells that changed since the previous record and, per cell,
+the XOR of its old and new word. XOR deltas apply in both directions, so a
+replay can step backwards as cheaply as forwards. Every record also holds
+the sidebar values of its step.
+
+Every keyframe_every-th record is a keyframe, so any step can be reached
+from the keyframe before it. FrameFile reads a recording through mmap and
+doesn't import simulate, so recordings can be replayed without the
+simulation code (see gui.py --replay).
+"""
+import json
+import mmap
+import struct
+from array import array
+
+from frames import Frame
+
+
+MAGIC = b'SIMFRM1\0'
+# Magic, x size, y size.
+HEADER = struct.Struct('<8sII')
+# Kind, time, number of words (keyframe) or changed cells (delta), and the
+# length of the encoded sidebar values.
+RECORD = struct.Struct('<BIII')
+KEYFRAME, DELTA = 0, 1
+
+
+class FrameRecorder:
+    """
+    Writes frames to a frame file. Call record() once per step and close()
+    when done.
+    """
+    def __init__(self, path, size, keyframe_every=100):
+        self.size = tuple(size)
+        self.n_cells = size[0] * size[1]
+        self.keyframe_every = keyframe_every
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, *self.size))
+        self.previous = None
+        self.n_frames = 0
+
+    def record(self, t, squares, stats=(), cells=None):
+        """
+        Appends the frame of step t: squares holds the summary word of
+        every cell and stats the sidebar as (label, text) pairs. cells are
+        the cells that can have changed since the previous frame (e.g.
+        SquareSummary.changed); by default every cell is compared.
+        """
+        encoded_stats = json.dumps(stats).encode()
+        if self.previous is None or self.n_frames % self.keyframe_every == 0:
+            self.previous = array('H', squares)
+            self.file.write(RECORD.pack(KEYFRAME, t, self.n_cells, len(encoded_stats)))
+            self.file.write(self.previous.tobytes())
+        else:
+            if cells is None:
+                cells = range(self.n_cells)
+            changed, xors = array('I'), array('H')
+            previous = self.previous
+            for cell in cells:
+                xor = previous[cell] ^ squares[cell]
+                if xor:
+                    changed.append(cell)
+                    xors.append(xor)
+                    previous[cell] = squares[cell]
+            self.file.write(RECORD.pack(DELTA, t, len(changed), len(encoded_stats)))
+            self.file.write(changed.tobytes())
+            self.file.write(xors.tobytes())
+        self.file.write(encoded_stats)
+        self.n_frames += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameFile:
+    """
+    Reads a frame file written by FrameRecorder, through mmap. frame(i)
+    returns the i-th recorded frame; moving to the next or previous frame
+    only applies one delta, and any other frame is rebuilt from the
+    keyframe before it.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, x_max, y_max = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a frame file")
+        self.size = (x_max, y_max)
+        self.n_cells = x_max * y_max
+        self.index_records()
+        self.squares = None
+        self.position = None
+
+    def index_records(self):
+        """
+        Finds the offset of every record. A record cut off at the end, by a
+        recorder that didn't finish, is left out.
+        """
+        self.offsets = []
+        self.keyframes = []
+        self.times = []
+        offset = HEADER.size
+        while offset + RECORD.size <= len(self.data):
+            kind, t, n, n_stats = RECORD.unpack_from(self.data, offset)
+            size = RECORD.size + n * (2 if kind == KEYFRAME else 6) + n_stats
+            if offset + size > len(self.data):
+                break
+            if kind == KEYFRAME:
+                self.keyframes.append(len(self.offsets))
+            self.offsets.append(offset)
+            self.times.append(t)
+            offset += size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def frame(self, index):
+        """ Returns the frame of the index-th record. """
+        if not 0 <= index < len(self):
+            raise IndexError("frame index out of range")
+        position = self.position
+        if position is not None and index == position + 1 and self.kind(index) == DELTA:
+            self.apply(index)
+        elif position is not None and index == position - 1 and self.kind(position) == DELTA:
+            self.apply(position)
+        elif index != position:
+            key = self.keyframes[self.keyframe_before(index)]
+            self.squares = self.read_keyframe(key)
+            for i in range(key + 1, index + 1):
+                self.apply(i)
+        self.position = index
+        return Frame(self.times[index], array('H', self.squares), self.read_stats(index))
+
+    def keyframe_before(self, index):
+        """ Returns the position in self.keyframes of the last one <= index. """
+        lo, hi = 0, len(self.keyframes)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.keyframes[mid] <= index:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def kind(self, index):
+        return self.data[self.offsets[index]]
+
+    def read_keyframe(self, index):
+        start = self.offsets[index] + RECORD.size
+        squares = array('H')
+        squares.frombytes(self.data[start:start + 2 * self.n_cells])
+        return squares
+
+    def apply(self, index):
+        """ XORs the delta of a record into the current squares. """
+        offset = self.offsets[index]
+        _, _, n, _ = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        cells, xors = array('I'), array('H')
+        cells.frombytes(self.data[start:start + 4 * n])
+        xors.frombytes(self.data[start + 4 * n:start + 6 * n])
+        squares = self.squares
+        for cell, xor in zip(cells, xors):
+            squares[cell] ^= xor
+
+    def read_stats(self, index):
+        offset = self.offsets[index]
+        kind, _, n, n_stats = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size + n * (2 if kind == KEYFRAME else 6)
+        return [tuple(pair) for pair in json.loads(self.data[start:start + n_stats])]
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
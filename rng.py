@@ -0,0 +1,71 @@
+"""
+Random number generators for simulations.
+
+Every Simulation draws from its own random.Random, so simulations don't
+share the global random state. A plain random.Random(seed) draws exactly
+the numbers the global random module would after random.seed(seed).
+"""
+import hashlib
+import itertools
+import random
+
+
+def make_rng(seed=None, fast=False):
+    """
+    Returns a generator for a simulation. fast selects a BlockRandom, which
+    pre-draws the floats for random() in bulk.
+    """
+    return BlockRandom(seed) if fast else random.Random(seed)
+
+
+class BlockRandom(random.Random):
+    """
+    A random.Random whose random() hands out floats that NumPy pre-draws in
+    blocks of block_size. The other methods (choice, randrange, shuffle, ...)
+    draw from the regular Mersenne Twister, so a BlockRandom is reproducible
+    for a given seed, but draws different numbers than random.Random(seed).
+    """
+    def __init__(self, seed=None, block_size=1 << 16):
+        self.block_size = block_size
+        super().__init__(seed)
+
+    def seed(self, a=None, version=2):
+        """ Seeds both the Mersenne Twister and the NumPy generator with a. """
+        import numpy as np
+
+        super().seed(a, version)
+        self.generator = np.random.default_rng(generator_seed(a))
+        # random() is an attribute of the instance, rather than a method, so
+        # drawing a float is a single C-level call on a chain of blocks.
+        self.random = itertools.chain.from_iterable(self._blocks()).__next__
+
+    def getstate(self):
+        """
+        Returns the state of both generators. The rest of the current block
+        is dropped, so the generator and any copy restored from this state
+        continue with the same fresh block.
+        """
+        self.random = itertools.chain.from_iterable(self._blocks()).__next__
+        return super().getstate(), self.generator.bit_generator.state
+
+    def setstate(self, state):
+        state, generator_state = state
+        super().setstate(state)
+        self.generator.bit_generator.state = generator_state
+        self.random = itertools.chain.from_iterable(self._blocks()).__next__
+
+    def _blocks(self):
+        while True:
+            yield self.generator.random(self.block_size).tolist()
+
+
+def generator_seed(a):
+    """
+    Returns a seed for NumPy's default_rng from a seed of random.seed: the
+    absolute value of an int, or a number derived from a str or bytes.
+    """
+    if a is None or isinstance(a, int):
+        return a if a is None else abs(a)
+    if isinstance(a, str):
+        a = a.encode()
+    return int.from_bytes(hashlib.sha512(a).digest(), 'big')
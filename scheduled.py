@@ -0,0 +1,332 @@
+"""
+Event-driven simulation engine.
+
+Most of what happens to an actor in a step is decided by a random check
+with a chance that is either constant (a mosquito moving or dying) or
+changes in a known way with time (hunger, age, the duration of an
+infection). Instead of drawing every check every step, EventSimulation
+samples the step at which each check will next succeed, and keeps the
+actor in a time-bucket wheel until then. Actors are only touched on the
+steps at which something happens to them.
+
+A bite only has an effect if there is a human on the mosquito's square, so
+a mosquito on a square without humans has no bite timer; it gets one when
+it moves to a square with a human or a human spawns on its square. Its
+hunger keeps growing meanwhile, and as the chance to bite only depends on
+the hunger, the timer can be sampled afresh at that point.
+
+The checks of a step are handled by kind (all moves, then all bites, then
+resistance and deaths) instead of actor by actor, and the reproduction
+check that never succeeds is not drawn. Runs are therefore not identical
+to those of Simulation for the same seed, but follow the same chances.
+"""
+import math
+from collections import defaultdict
+
+from simulate import Simulation, Human, Mosquito
+
+
+# The kinds of timers, in the order in which they are handled within a step.
+MOVE, BITE, RESIST, NATURAL_DEATH, MALARIA_DEATH, MOSQUITO_DEATH = range(6)
+KINDS = 6
+HANDLERS = ('on_move', 'on_bite', 'on_resist', 'on_natural_death', 'on_malaria_death',
+            'on_mosquito_death')
+
+
+def geometric(rng, p):
+    """
+    Returns the number of steps until a check with chance p per step
+    succeeds, or None if it never does.
+    """
+    if p <= 0:
+        return None
+    if p >= 1:
+        return 1
+    return int(math.log(1.0 - rng.random()) / math.log(1.0 - p)) + 1
+
+
+def linear_hazard(rng, p0, slope):
+    """
+    Returns the number of steps until a check succeeds whose chance is p0
+    at the first step and grows by slope every step, or None if it never
+    does. Draws a single random number.
+    """
+    if slope <= 0:
+        return geometric(rng, p0)
+    u = rng.random()
+    survival = 1.0
+    k = 0
+    while True:
+        k += 1
+        p = p0 + slope * (k - 1)
+        if p >= 1:
+            return k
+        if p > 0:
+            survival *= 1 - p
+            if survival <= u:
+                return k
+
+
+class EventSimulation(Simulation):
+    """
+    Represents a simulation in which actors are only stepped when one of
+    their random timers expires.
+
+    Every actor has a timer per check (see KINDS), holding the step at which
+    the check next succeeds. The wheel maps a step to the actors whose
+    timers expire then, per kind. Timers are not removed when they become
+    invalid (e.g. when an infected human is vaccinated); an expired timer is
+    ignored unless it is still the actor's current timer of that kind.
+
+    The hunger of mosquitos and the age of humans change every step, so they
+    are only brought up to date when they are needed (see sync).
+    """
+    def __init__(self, *args, **kwargs):
+        self.reset_timers()
+        super().__init__(*args, **kwargs)
+
+    def reset_timers(self):
+        self.wheel = defaultdict(lambda: [[] for _ in range(KINDS)])
+        self.due = {}
+        # The step at which each human spawned, and the step at which the
+        # hunger of each mosquito was last brought up to date.
+        self.born = {}
+        self.fed = {}
+        self.resist_count = {}
+        # Spawn order, to handle the mosquitos on a square in a fixed order.
+        self.serial = {}
+        self.n_started = 0
+
+    def step(self):
+        self.t += 1
+        self.stats.step()
+
+        # Handlers can set timers that expire later in this step, so the
+        # bucket is only removed once all kinds have been handled.
+        due = self.wheel.get(self.t)
+        if due is not None:
+            for kind, name in enumerate(HANDLERS):
+                handler = getattr(self, name)
+                for actor in due[kind]:
+                    if not actor._dead and self.due[actor][kind] == self.t:
+                        handler(actor)
+            del self.wheel[self.t]
+
+        if self.deaths:
+            deaths, self.deaths = self.deaths, []
+            self.handle_deaths(deaths)
+
+    def schedule(self, actor, kind, delay):
+        """
+        Sets a timer of actor to expire delay steps from now. A delay of 0
+        can only be used for a kind that is handled later in this step.
+        """
+        timers = self.due[actor]
+        if delay is None:
+            timers[kind] = None
+            return
+        t = self.t + delay
+        if timers[kind] != t:
+            timers[kind] = t
+            self.wheel[t][kind].append(actor)
+
+    def start_timers(self, actor):
+        """ Samples all timers of an actor that is new or was restored. """
+        self.due[actor] = [None] * KINDS
+        self.serial[actor] = self.n_started
+        self.n_started += 1
+        if type(actor) is Human:
+            self.born.setdefault(actor, self.t - actor.age)
+            self.schedule_natural_death(actor)
+            if actor.infected and not actor.immune:
+                self.schedule_infection(actor)
+        else:
+            self.fed[actor] = self.t + 1
+            cfg = actor.config
+            self.schedule(actor, MOVE, geometric(self.random, cfg.move_chance))
+            if self.grid.counts[Human][self.grid.cell_of(actor)]:
+                self.schedule_bite(actor)
+            self.schedule(actor, MOSQUITO_DEATH, geometric(self.random, cfg.simple_death_chance))
+
+    def schedule_bite(self, mosquito, this_step=False):
+        """
+        Schedules the next bite of a mosquito, whose chance grows with its
+        hunger (see Mosquito.will_bite) and is 0 while it isn't hungry. With
+        this_step, the check of the current step is still to come.
+        """
+        cfg = mosquito.config
+        per_hunger = cfg.bite_chance / -cfg.fed_hunger
+        # The hunger at the first check, and the steps until it is no longer
+        # negative.
+        start = self.t + (not this_step)
+        hunger = mosquito.hunger + (start - self.fed[mosquito])
+        wait = max(0, math.ceil(-hunger))
+        delay = linear_hazard(self.random, (hunger + wait) * per_hunger, per_hunger)
+        self.schedule(mosquito, BITE, None if delay is None else wait + delay - this_step)
+
+    def schedule_natural_death(self, human):
+        cfg = human.config
+        age = self.t - self.born[human]
+        self.schedule(human, NATURAL_DEATH, linear_hazard(
+            self.random, age * cfg.age_death_factor + cfg.death_base, cfg.age_death_factor))
+
+    def schedule_infection(self, human):
+        """ Schedules resistance and malaria death for an infected human. """
+        cfg = human.config
+        self.schedule_resistance(human)
+        duration = self.t + 1 - human.infection_time
+        self.schedule(human, MALARIA_DEATH, linear_hazard(
+            self.random, cfg.malaria_death_chance + duration / 10000, 1 / 10000))
+
+    def schedule_resistance(self, human, this_step=False):
+        """
+        Schedules an infected human to become resistant; the chance grows
+        with the number of infections. With this_step, the check of the
+        current step is still to come.
+        """
+        cfg = human.config
+        self.resist_count[human] = human.infection_count
+        delay = geometric(
+            self.random,
+            cfg.resistance_base + human.infection_count * cfg.infection_resistance_factor)
+        self.schedule(human, RESIST, delay - this_step if delay else None)
+
+    # Timer handlers, in the order of KINDS.
+
+    def on_move(self, mosquito):
+        grid = self.grid
+        old_cell = grid.cell_of(mosquito)
+        mosquito.move()
+        self.schedule(mosquito, MOVE, geometric(self.random, mosquito.config.move_chance))
+
+        cell = grid.cell_of(mosquito)
+        if cell == old_cell:
+            return
+        if not grid.counts[Human][cell]:
+            self.schedule(mosquito, BITE, None)
+        elif self.due[mosquito][BITE] is None:
+            self.schedule_bite(mosquito, this_step=True)
+
+    def on_bite(self, mosquito):
+        mosquito.hunger += self.t - self.fed[mosquito]
+        self.fed[mosquito] = self.t
+        mosquito.bite()
+        if self.grid.counts[Human][self.grid.cell_of(mosquito)]:
+            self.schedule_bite(mosquito)
+        else:
+            self.schedule(mosquito, BITE, None)
+
+        # A bite can reinfect an infected human, which raises its chance to
+        # become resistant, starting with the check later in this step.
+        for human in self.grid.actors_in(self.grid.cell_of(mosquito), Human):
+            if (human.infected and not human.immune and
+                    human.infection_count != self.resist_count.get(human)):
+                self.schedule_resistance(human, this_step=True)
+
+    def on_resist(self, human):
+        if human.infected and not human.immune:
+            human.immune = True
+
+    def on_natural_death(self, human):
+        self.kill(human)
+
+    def on_malaria_death(self, human):
+        if human.infected and not human.immune:
+            self.kill(human)
+
+    def on_mosquito_death(self, mosquito):
+        self.kill(mosquito)
+
+    def kill(self, actor):
+        actor._dead = True
+        self.died(actor)
+
+    # Hooks into Simulation.
+
+    def spawn_actor(self, cls, square, vax=False, use_net=False):
+        obj = super().spawn_actor(cls, square, vax, use_net)
+        self.start_timers(obj)
+        if cls is Human:
+            # The mosquitos on the square can bite again.
+            waiting = [mosquito for mosquito in self.grid.actors_in(square.cell, Mosquito)
+                       if self.due[mosquito][BITE] is None]
+            for mosquito in sorted(waiting, key=self.serial.get):
+                self.schedule_bite(mosquito)
+        return obj
+
+    def flag_changed(self, obj, flag, delta):
+        super().flag_changed(obj, flag, delta)
+        if flag == 'infected' and delta > 0 and type(obj) is Human and obj in self.due:
+            self.schedule_infection(obj)
+
+    def handle_deaths(self, deaths):
+        for obj in deaths:
+            del self.due[obj]
+            self.born.pop(obj, None)
+            self.fed.pop(obj, None)
+            self.resist_count.pop(obj, None)
+            del self.serial[obj]
+        super().handle_deaths(deaths)
+
+    def handle_death(self, obj):
+        self.handle_deaths([obj])
+
+    def sync(self):
+        """ Brings the hunger of mosquitos and the age of humans up to date. """
+        for actor in self.actors:
+            if type(actor) is Human:
+                actor.age = self.t - self.born[actor]
+            else:
+                actor.hunger += self.t + 1 - self.fed[actor]
+                self.fed[actor] = self.t + 1
+
+    def snapshot(self):
+        """
+        Returns a snapshot (see Simulation.snapshot) that also holds the
+        timers, per actor in registry order, and the wheel.
+        """
+        self.sync()
+        snapshot = super().snapshot()
+        actors = list(self.actors)
+        row = {actor: i for i, actor in enumerate(actors)}
+        snapshot['timers'] = {
+            'due': [list(self.due[actor]) for actor in actors],
+            'born': [self.born.get(actor) for actor in actors],
+            'resist_count': [self.resist_count.get(actor) for actor in actors],
+            'serial': [self.serial[actor] for actor in actors],
+            'n_started': self.n_started,
+            # Expired timers are kept: one that is set again to the same
+            # step is handled at its old place in the bucket.
+            'wheel': {t: [[row[actor] for actor in bucket if actor in row]
+                          for bucket in buckets]
+                      for t, buckets in self.wheel.items()},
+        }
+        return snapshot
+
+    def restore(self, snapshot):
+        """
+        Restores a snapshot. A snapshot of a Simulation has no timers, so
+        new ones are sampled for all actors; the chances only depend on the
+        restored state, so the simulation continues with the same chances.
+        """
+        super().restore(snapshot)
+        self.reset_timers()
+        actors = list(self.actors)
+        timers = snapshot.get('timers')
+        if timers is None:
+            for actor in actors:
+                self.start_timers(actor)
+            return
+
+        for i, actor in enumerate(actors):
+            self.due[actor] = list(timers['due'][i])
+            self.serial[actor] = timers['serial'][i]
+            if type(actor) is Human:
+                self.born[actor] = timers['born'][i]
+                if timers['resist_count'][i] is not None:
+                    self.resist_count[actor] = timers['resist_count'][i]
+            else:
+                self.fed[actor] = self.t + 1
+        self.n_started = timers['n_started']
+        for t, buckets in timers['wheel'].items():
+            self.wheel[t] = [[actors[i] for i in bucket] for bucket in buckets]
@@ -1,8 +1,13 @@
 import config
 import random
+from rng import make_rng
 from mixins import *
-from stats import SimStats
+from stats import SimStats, ActorCounts
+from array import array
 from collections import defaultdict
+import functools
+import pickle
+import zlib
 from event import Event
 import itertools
 
@@ -16,7 +21,7 @@ class Human(Actor, Infectable, NaturalDeath, MalariaDeath):
         # Check if human will develop immunity
         if self.infected:
             resistance_chance = self.config.resistance_base + self.infection_count * self.config.infection_resistance_factor
-            if random.random() < resistance_chance:
+            if self.sim.random.random() < resistance_chance:
                 self.immune = True
 
         self.all_super_step()
@@ -40,13 +45,45 @@ class Human(Actor, Infectable, NaturalDeath, MalariaDeath):
         if self.use_net:
             return
 
-        if (self.infected and random.random() <
+        if (self.infected and self.sim.random.random() <
             self.config.mosquito_infection_chance):
             mosquito.infect()
 
-        if mosquito.infected and random.random() < mosquito.config.human_infection_chance:
+        if mosquito.infected and self.sim.random.random() < mosquito.config.human_infection_chance:
             self.infect()
 
+    def get_bitten_many(self, mosquito, n):
+        """
+        Applies n bites of mosquitos in the same state as mosquito, with the
+        same chances as n calls of get_bitten. Instead of infecting mosquito,
+        returns how many of the n mosquitos became infected.
+        """
+        if mosquito.vaccinated:
+            self.vaccinated = True
+            self.infected = False
+            self.immune = False
+
+        if not mosquito.infected and not self.infected:
+            return 0
+
+        if self.vaccinated:
+            return 0
+
+        if self.use_net:
+            return 0
+
+        # Mosquitos that were infected by this bite can infect the human
+        # right away, like in get_bitten.
+        infected = 0
+        if not mosquito.infected:
+            infected = self.sim.binomial(n, self.config.mosquito_infection_chance)
+            n = infected
+
+        times = self.sim.binomial(n, mosquito.config.human_infection_chance)
+        if times:
+            self.infect(times)
+        return infected
+
 
 class Mosquito(Actor, Hunger, Infectable, SimpleDeath):
     """ Represents a mosquito. """
@@ -57,7 +94,7 @@ class Mosquito(Actor, Hunger, Infectable, SimpleDeath):
         self.vaccinated = has_vaccine
 
     def will_bite(self):
-        r = random.random()
+        r = self.sim.random.random()
         max_hunger = -self.config.fed_hunger
         chance = self.config.bite_chance
         if self.hunger < 0:
@@ -66,13 +103,13 @@ class Mosquito(Actor, Hunger, Infectable, SimpleDeath):
             return r < chance * (self.hunger / max_hunger)
 
     def step(self):
-        if random.random() < self.config.move_chance:
+        if self.sim.random.random() < self.config.move_chance:
             self.move()
         if self.will_bite():
             self.bite()
-        if random.random() < self.config.reproduction_chance and False:
+        if self.sim.random.random() < self.config.reproduction_chance and False:
             # Yes, this never executes. We need to keep the if-statement in,
-            # because the random.random() call influences the random state.
+            # because the random() call influences the random state.
             self.sim.spawn_actor(Mosquito, self.sim.grid.get_square(self))
 
         self.all_super_step()
@@ -82,19 +119,10 @@ class Mosquito(Actor, Hunger, Infectable, SimpleDeath):
 
     def move(self):
         """ Moves the mosquito to an adjacent grid square. """
-        orig_sq = self.sim.grid.get_square(self)
-        new_sq = orig_sq
-
-        x_off, y_off = random.choice(self.possible_moves)
-
-        x, y = orig_sq.pos
-
-        try:
-            new_sq  = self.sim.grid[x + x_off, y + y_off]
-            orig_sq.remove(self)
-            new_sq.add(self)
-        except ValueError:
-            pass
+        grid = self.sim.grid
+        new_cell = grid.move_target(grid.cell_of(self), self.sim.random.randrange(8))
+        if new_cell >= 0:
+            grid.move(self, new_cell)
 
     def bite(self):
         """
@@ -103,13 +131,18 @@ class Mosquito(Actor, Hunger, Infectable, SimpleDeath):
         if self.hunger < 0:
             return
 
-        own_square = self.sim.grid.get_square(self)
+        grid = self.sim.grid
+        cell = grid.cell_of(self)
+        if not grid.counts[Human][cell]:
+            return
 
-        for actor in own_square:
-            if actor.is_human():
-                nut_value = random.random()*(self.config.fed_hunger - self.config.base_bite_nutrition)
-                self.hunger -= self.config.base_bite_nutrition + nut_value
-                actor.get_bitten(self)
+        for actor in grid.actors_in(cell, Human):
+            if actor._dead:
+                # Died this step; it is removed when the deaths are handled.
+                continue
+            nut_value = self.sim.random.random()*(self.config.fed_hunger - self.config.base_bite_nutrition)
+            self.hunger -= self.config.base_bite_nutrition + nut_value
+            actor.get_bitten(self)
 
 
 
@@ -121,58 +154,534 @@ class GridSquareProxy:
     def __init__(self, grid, *pos):
         self.grid = grid
         self.pos  = pos
+        self.cell = grid.cell(pos)
 
     def add(self, obj):
-        self.grid[obj] = self.pos
-        self.grid[self.pos].add(obj)
+        self.grid.place(obj, self.cell)
 
     def remove(self, obj):
-        del self.grid[obj]
-        self.grid[self.pos].remove(obj)
+        self.grid.remove(obj)
 
     def __contains__(self, obj):
-        return obj in self.grid[self.pos]
+        # Actors that aren't on the grid (any more) are in no square.
+        return self.grid._cell_of.get(obj) == self.cell
 
     def __iter__(self):
-        return iter(self.grid[self.pos])
+        return self.grid.actors_in(self.cell)
 
     def __bool__(self):
-        return bool(self.grid[self.pos])
+        return any(counts[self.cell] for counts in self.grid.counts.values())
 
     def __repr__(self):
-        return f"Grid square at {self.pos} containing ({self.grid[self.pos]})"
+        return f"Grid square at {self.pos} containing ({set(self)})"
+
+
+class IndexedSet:
+    """
+    A set that also supports picking a uniformly random member in constant
+    time. Removal moves the last member into the freed slot, so the order of
+    the members changes when members are removed.
+    """
+    def __init__(self, items=()):
+        self._items = list(items)
+        self._index = {item: i for i, item in enumerate(self._items)}
+
+    def add(self, item):
+        self._index[item] = len(self._items)
+        self._items.append(item)
+
+    def remove(self, item):
+        i = self._index.pop(item)
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._index[last] = i
+
+    def random_choice(self, rng=random):
+        return rng.choice(self._items)
+
+    def copy(self):
+        return self._items.copy()
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class CellSet(IndexedSet):
+    """
+    An IndexedSet of cell ids in range(n_cells), stored in two flat arrays
+    instead of a list and a dict.
+    """
+    def __init__(self, n_cells, full=False):
+        if full:
+            self._items = array('l', range(n_cells))
+            self._index = array('l', range(n_cells))
+        else:
+            self._items = array('l')
+            self._index = array('l', [-1]) * n_cells
+
+    @classmethod
+    def from_items(cls, n_cells, items):
+        """ Returns a CellSet holding items, in that order. """
+        cell_set = cls(n_cells)
+        cell_set._items = array('l', items)
+        for i, cell in enumerate(cell_set._items):
+            cell_set._index[cell] = i
+        return cell_set
+
+    def add(self, cell):
+        self._index[cell] = len(self._items)
+        self._items.append(cell)
+
+    def remove(self, cell):
+        i = self._index[cell]
+        self._index[cell] = -1
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._index[last] = i
+
+    def copy(self):
+        return list(self._items)
+
+    def __contains__(self, cell):
+        return self._index[cell] >= 0
+
+
+class GridIndices:
+    """
+    The sequence of all (x, y) positions of a grid, in cell order. The
+    positions are computed when they are read, so it takes no memory.
+    """
+    def __init__(self, x_max, y_max):
+        self.x_max, self.y_max = x_max, y_max
+
+    def __len__(self):
+        return self.x_max * self.y_max
+
+    def __getitem__(self, cell):
+        if not 0 <= cell < len(self):
+            raise IndexError("grid index out of range")
+        return divmod(cell, self.y_max)
+
+    def __iter__(self):
+        return itertools.product(range(self.x_max), range(self.y_max))
 
 
 class Grid:
     """
     Represents an NxM grid that actors are placed in.
+
+    Squares are stored as flat cells: square (x, y) has cell id x * y_max + y.
+    For every actor class the grid keeps the actors in each cell, the number
+    of actors in each cell and the number of infected and vaccinated actors
+    in each cell. The neighbours of every cell are precomputed, so actors
+    can be moved without bounds checks.
+
+    After track_dirty() the grid also records which cells changed (actors
+    added, removed or moved, or flags changed), until take_dirty() is called.
+
+    The grid also keeps an index of the cells that contain no human, and for
+    every human the number of human-free cells around it, so that new
+    humans can be placed in constant time.
     """
-    def __init__(self, x_max, y_max):
+    move_offsets = Mosquito.possible_moves
+    neighbour_offsets = [i for i in itertools.product((-1, 0, 1), (-1, 0, 1))
+                         if i != (0, 0)]
+    tracked_flags = ('infected', 'vaccinated')
+
+    def __init__(self, x_max, y_max, rng=random):
         self.x_max, self.y_max = x_max, y_max
-        self._grid = defaultdict(set)
-        self.indices = [*itertools.product(range(x_max), range(y_max))]
+        self.random = rng
+        self.n_cells = x_max * y_max
+        self.indices = GridIndices(x_max, y_max)
+
+        self._cell_of = {}
+        self._cells = defaultdict(self._new_cells)
+        self.counts = defaultdict(self._new_counts)
+        self.infected = defaultdict(self._new_counts)
+        self.vaccinated = defaultdict(self._new_counts)
+        self.dirty = None
+        self._neighbour_order = [self.move_offsets.index(offset)
+                                 for offset in self.neighbour_offsets]
+        self._init_index()
+
+    def _init_index(self):
+        """ Builds the neighbour table and the free-cell index. """
+        self._neighbours = neighbour_table(self.x_max, self.y_max, tuple(self.move_offsets))
+        self._free = CellSet(self.n_cells, full=True)
+        self._free_neighbours = array('l', [-1]) * self.n_cells
+        self._open = CellSet(self.n_cells)
+
+    def _new_cells(self):
+        return [None] * self.n_cells
+
+    def _new_counts(self):
+        return array('l', [0]) * self.n_cells
+
+    def cell(self, pos):
+        x, y = pos
+        return x * self.y_max + y
+
+    def pos(self, cell):
+        return divmod(cell, self.y_max)
+
+    def cell_of(self, obj):
+        return self._cell_of[obj]
+
+    def actors_in(self, cell, cls=None):
+        """ Returns an iterator over the actors (of class cls) in a cell. """
+        if cls is not None:
+            return iter(self._cells[cls][cell] or ())
+        return itertools.chain.from_iterable(
+            cells[cell] or () for cells in self._cells.values())
+
+    def place(self, obj, cell):
+        cls = type(obj)
+        self._cell_of[obj] = cell
+        cells = self._cells[cls]
+        if cells[cell] is None:
+            cells[cell] = set()
+        cells[cell].add(obj)
+
+        counts = self.counts[cls]
+        counts[cell] += 1
+        if obj.infected:
+            self.infected[cls][cell] += 1
+        if obj.vaccinated:
+            self.vaccinated[cls][cell] += 1
+        if cls is Human and counts[cell] == 1:
+            self._occupy(cell)
+        if self.dirty is not None:
+            self.dirty.add(cell)
+
+    def remove(self, obj):
+        cls = type(obj)
+        cell = self._cell_of.pop(obj)
+        cells = self._cells[cls]
+        cells[cell].remove(obj)
+        if not cells[cell]:
+            cells[cell] = None
+
+        counts = self.counts[cls]
+        counts[cell] -= 1
+        if obj.infected:
+            self.infected[cls][cell] -= 1
+        if obj.vaccinated:
+            self.vaccinated[cls][cell] -= 1
+        if cls is Human and not counts[cell]:
+            self._vacate(cell)
+        if self.dirty is not None:
+            self.dirty.add(cell)
+
+    def add(self, obj, pos):
+        self.place(obj, self.cell(pos))
+
+    def move(self, obj, cell):
+        self.remove(obj)
+        self.place(obj, cell)
+
+    def flag_changed(self, obj, flag, delta):
+        """ Updates the per-cell counts after a flag of obj changed. """
+        cell = self._cell_of.get(obj)
+        if cell is None:
+            return
+        if flag in self.tracked_flags:
+            getattr(self, flag)[type(obj)][cell] += delta
+        if self.dirty is not None:
+            self.dirty.add(cell)
+
+    def track_dirty(self):
+        """ Starts recording which cells change. """
+        self.dirty = set()
+
+    def take_dirty(self):
+        """ Returns the cells that changed since the previous call. """
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def get_index_state(self):
+        """
+        Returns a copy of the free-cell index. Its order determines which
+        squares random placements pick, so restoring it makes a restored
+        grid place new humans exactly like the original.
+        """
+        return (array('l', self._free._items), array('l', self._open._items),
+                array('l', self._free_neighbours))
+
+    def set_index_state(self, state):
+        free, open_cells, free_neighbours = state
+        self._free = CellSet.from_items(self.n_cells, free)
+        self._open = CellSet.from_items(self.n_cells, open_cells)
+        self._free_neighbours = array('l', free_neighbours)
 
     def get_square(self, obj):
-        if obj not in self._grid:
+        if obj not in self._cell_of:
             raise ValueError(f"{obj} is not in the grid!")
 
-        return GridSquareProxy(self._grid, *self._grid[obj])
+        return GridSquareProxy(self, *self.pos(self._cell_of[obj]))
 
 
     def __getitem__(self, index):
         x, y = index
         if (x < 0 or x >= self.x_max or y < 0 or y >= self.y_max):
             raise ValueError("Cannot get square outside of the grid.")
-        return GridSquareProxy(self._grid, *index)
+        return GridSquareProxy(self, *index)
+
+    def move_target(self, cell, k):
+        """
+        Returns the cell reached by moving from cell by move_offsets[k], or
+        -1 if that is outside the grid.
+        """
+        return self._neighbours[len(self.move_offsets) * cell + k]
+
+    def neighbours(self, cell):
+        """ Yields the cells around cell that are inside the grid. """
+        base = len(self.move_offsets) * cell
+        for k in self._neighbour_order:
+            n_cell = self._neighbours[base + k]
+            if n_cell >= 0:
+                yield n_cell
 
     def get_random_square(self, predicate=None):
         if not predicate:
-            x, y = random.choice(self.indices)
-            return GridSquareProxy(self._grid, x, y)
+            x, y = self.random.choice(self.indices)
+            return GridSquareProxy(self, x, y)
 
         squares_matching_predicate = [k for k in self.indices
-                                      if predicate(self._grid[k])]
-        return GridSquareProxy(self._grid, *random.choice(squares_matching_predicate))
+                                      if predicate(self[k])]
+        return GridSquareProxy(self, *self.random.choice(squares_matching_predicate))
+
+    def get_random_free_square(self):
+        """ Returns a uniformly chosen square that contains no human. """
+        return GridSquareProxy(self, *self.pos(self._free.random_choice(self.random)))
+
+    def get_random_cluster_square(self):
+        """
+        Returns the first human-free square around a uniformly chosen human
+        that has one, or None if no human has a free square around it.
+        """
+        if not self._open:
+            return None
+        cell = self._open.random_choice(self.random)
+        for n_cell in self.neighbours(cell):
+            if n_cell in self._free:
+                return GridSquareProxy(self, *self.pos(n_cell))
+
+    def _occupy(self, cell):
+        """ Updates the free-cell index after a human moved into cell. """
+        self._free.remove(cell)
+        n_free = 0
+        for n_cell in self.neighbours(cell):
+            if self._free_neighbours[n_cell] >= 0:
+                self._set_free_neighbours(n_cell, self._free_neighbours[n_cell] - 1)
+            else:
+                n_free += 1
+        self._set_free_neighbours(cell, n_free)
+
+    def _vacate(self, cell):
+        """ Updates the free-cell index after the last human left cell. """
+        self._set_free_neighbours(cell, 0)
+        self._free_neighbours[cell] = -1
+        self._free.add(cell)
+        for n_cell in self.neighbours(cell):
+            if self._free_neighbours[n_cell] >= 0:
+                self._set_free_neighbours(n_cell, self._free_neighbours[n_cell] + 1)
+
+    def _set_free_neighbours(self, cell, n):
+        old = max(self._free_neighbours[cell], 0)
+        self._free_neighbours[cell] = n
+        if n and not old:
+            self._open.add(cell)
+        elif old and not n:
+            self._open.remove(cell)
+
+@functools.lru_cache(maxsize=None)
+def neighbour_table(x_max, y_max, offsets):
+    """
+    Returns a flat table in which entry len(offsets) * cell + k is the cell
+    reached from cell by offsets[k], or -1 if that is outside the grid. The
+    table is shared by all grids of the same size, so it must not be changed.
+    """
+    n_moves = len(offsets)
+    table = array('l', [-1]) * (n_moves * x_max * y_max)
+    for k, (x_off, y_off) in enumerate(offsets):
+        y_start, y_end = max(0, -y_off), min(y_max, y_max - y_off)
+        for x in range(max(0, -x_off), min(x_max, x_max - x_off)):
+            cell = x * y_max
+            target = (x + x_off) * y_max + y_off
+            table[n_moves * (cell + y_start) + k:n_moves * (cell + y_end) + k:n_moves] = \
+                array('l', range(target + y_start, target + y_end))
+    return table
+
+class SparseCells(dict):
+    """
+    A dict from cell id to value that reads as default for the cells it
+    doesn't hold, so it can stand in for a flat per-cell list or array.
+    """
+    def __init__(self, default):
+        self.default = default
+
+    def __missing__(self, cell):
+        return self.default
+
+
+class SparseGrid(Grid):
+    """
+    A Grid for very large maps that are mostly empty. Only the occupied
+    cells are stored, so its memory grows with the number of actors instead
+    of the area.
+
+    Neighbours are computed when they are needed, and free squares are
+    found by rejection sampling: random cells are drawn until one contains
+    no human. The cells that contain a human are kept in an IndexedSet, from
+    which cluster squares are sampled the same way. When a map gets so full
+    that sampling keeps failing, the candidates are enumerated instead.
+    """
+    max_tries = 64
+
+    def _init_index(self):
+        self._occupied = IndexedSet()
+
+    def _new_cells(self):
+        return SparseCells(None)
+
+    def _new_counts(self):
+        return SparseCells(0)
+
+    def remove(self, obj):
+        cls = type(obj)
+        cell = self._cell_of[obj]
+        super().remove(obj)
+        # Drop the entries of the cell that went back to their default.
+        for table in (self._cells, self.counts, self.infected, self.vaccinated):
+            cells = table[cls]
+            if cell in cells and not cells[cell]:
+                del cells[cell]
+
+    def move_target(self, cell, k):
+        x, y = divmod(cell, self.y_max)
+        x_off, y_off = self.move_offsets[k]
+        x, y = x + x_off, y + y_off
+        if 0 <= x < self.x_max and 0 <= y < self.y_max:
+            return x * self.y_max + y
+        return -1
+
+    def neighbours(self, cell):
+        for k in self._neighbour_order:
+            n_cell = self.move_target(cell, k)
+            if n_cell >= 0:
+                yield n_cell
+
+    def get_random_square(self, predicate=None):
+        if not predicate:
+            return GridSquareProxy(self, *self.pos(self.random.randrange(self.n_cells)))
+        return super().get_random_square(predicate)
+
+    def get_random_free_square(self):
+        humans = self.counts[Human]
+        for _ in range(self.max_tries):
+            cell = self.random.randrange(self.n_cells)
+            if not humans[cell]:
+                return GridSquareProxy(self, *self.pos(cell))
+        free = [cell for cell in range(self.n_cells) if not humans[cell]]
+        return GridSquareProxy(self, *self.pos(self.random.choice(free)))
+
+    def get_random_cluster_square(self):
+        if not self._occupied:
+            return None
+        for _ in range(self.max_tries):
+            square = self._free_neighbour(self._occupied.random_choice(self.random))
+            if square is not None:
+                return square
+        open_cells = [cell for cell in self._occupied if self._free_neighbour(cell)]
+        if not open_cells:
+            return None
+        return self._free_neighbour(self.random.choice(open_cells))
+
+    def _free_neighbour(self, cell):
+        """ Returns the first human-free square around cell, if any. """
+        humans = self.counts[Human]
+        for n_cell in self.neighbours(cell):
+            if not humans[n_cell]:
+                return GridSquareProxy(self, *self.pos(n_cell))
+
+    def _occupy(self, cell):
+        self._occupied.add(cell)
+
+    def _vacate(self, cell):
+        self._occupied.remove(cell)
+
+    def get_index_state(self):
+        return (array('l', self._occupied),)
+
+    def set_index_state(self, state):
+        self._occupied = IndexedSet(state[0])
+
+
+class ActorRegistry:
+    """
+    Keeps track of the actors in a simulation.
+
+    Actors can be added and removed in constant time; removal moves the last
+    actor into the freed slot. The registry also keeps the actors of each
+    class separately, so a random actor of a class can be picked in constant
+    time. Iterate over a copy() to get an order that stays stable while
+    actors are added and removed.
+    """
+    def __init__(self, rng=random):
+        self.random = rng
+        self._actors = IndexedSet()
+        self._by_class = defaultdict(IndexedSet)
+
+    def add(self, obj):
+        self._actors.add(obj)
+        self._by_class[type(obj)].add(obj)
+
+    def remove(self, obj):
+        self._actors.remove(obj)
+        self._by_class[type(obj)].remove(obj)
+
+    @classmethod
+    def from_lists(cls, rng, actors, by_class):
+        """
+        Returns a registry holding actors, in that order. by_class maps each
+        actor class to the list of its actors, in the order to keep for it.
+        """
+        registry = cls(rng)
+        registry._actors = IndexedSet(actors)
+        for actor_cls, members in by_class.items():
+            registry._by_class[actor_cls] = IndexedSet(members)
+        return registry
+
+    def of_class(self, cls):
+        """ Returns a list of all actors of the given class. """
+        return self._by_class[cls].copy()
+
+    def count(self, cls):
+        return len(self._by_class[cls])
+
+    def random_choice(self, cls):
+        """ Returns a uniformly chosen actor of the given class. """
+        return self._by_class[cls].random_choice(self.random)
+
+    def copy(self):
+        return self._actors.copy()
+
+    def __contains__(self, obj):
+        return obj in self._actors
+
+    def __iter__(self):
+        return iter(self._actors)
+
+    def __len__(self):
+        return len(self._actors)
 
 def not_contains_class(cls):
     """
@@ -186,21 +695,54 @@ def not_contains_class(cls):
 class Simulation:
     """
     Represents a simulation with actors in a Cartesian grid.
+
+    All random draws of the simulation, its actors and its grid come from
+    self.random. Pass a seed to make a run reproducible; a seeded run draws
+    the same numbers as the global random module after random.seed(seed).
+    With fast_random, random() draws from pre-drawn blocks instead (see
+    rng.BlockRandom). An existing generator can be passed as rng.
+
+    snapshot() captures the complete state of a simulation as plain data,
+    which restore() (or from_snapshot()) turns back into a simulation that
+    continues exactly like the original. fork() clones a running simulation,
+    so several scenarios can continue from one warmed-up state, and
+    save_checkpoint()/load_checkpoint() store snapshots on disk.
+
+    Actors that die during a step are collected and handled together at the
+    end of the step (see handle_deaths). With batch_deaths=False every death
+    is instead handled as soon as the actor dies, through the on_death event,
+    which reproduces the random draws of runs from before batching.
     """
-    def __init__(self, config):
+    checkpoint_magic = b'SIMCKPT1'
+    flags = ('spawned_mosquitos', 'vax_mosquitos', 'use_net')
+    # Whether populating the grid infects the first human.
+    seed_infection = True
+
+    def __init__(self, config, seed=None, fast_random=False, rng=None,
+                 populate=True, batch_deaths=True):
         self.config = config
-        self.grid = Grid(*config.Grid.size)
+        self.random = rng or make_rng(seed, fast_random)
+        self.grid = self.make_grid()
         self.stats = SimStats(self)
         self.t = 0
         self.spawned_mosquitos = False
         self.vax_mosquitos = False
         self.use_net = False
 
-        self.actors = []
+        self.actors = ActorRegistry(self.random)
+        self.counts = {'Human': ActorCounts(), 'Mosquito': ActorCounts()}
+        self.batch_deaths = batch_deaths
+        self.deaths = []
+        self.on_death = Event('on_death').hook(self.handle_death)
 
-        self.populate_grid()
+        if populate:
+            self.populate_grid()
 
 
+    def make_grid(self):
+        grid_cls = SparseGrid if getattr(self.config.Grid, 'sparse', False) else Grid
+        return grid_cls(*self.config.Grid.size, rng=self.random)
+
     def init_grid(self):
         for x in range(self.grid.x_max):
             for y in range(self.grid.y_max):
@@ -220,12 +762,16 @@ class Simulation:
             actor.step()
             actor.end_step()
 
+        if self.deaths:
+            deaths, self.deaths = self.deaths, []
+            self.handle_deaths(deaths)
+
     def populate_grid(self):
         self.populate_human()
         self.populate_mosquito()
 
     def populate_human(self):
-        first_human = True
+        first_human = self.seed_infection
         n = round(self.config.Human.dens * (self.grid.x_max * self.grid.y_max))
         for i in range(self.config.Human.n if self.config.Human.populate_absolute else n):
             obj = self.new_human()
@@ -233,24 +779,60 @@ class Simulation:
             if first_human:
                 obj.infect()
                 first_human = False
-            elif random.random() < self.config.Human.pre_infection_prob:
+            elif self.random.random() < self.config.Human.pre_infection_prob:
                 obj.infect()
 
     def populate_mosquito(self):
         for i in range(self.config.Mosquito.n):
             obj = self.new_mosquito()
 
+    def died(self, obj):
+        """ Called by an actor that died during its step. """
+        if self.batch_deaths:
+            self.deaths.append(obj)
+        else:
+            self.on_death.fire(obj)
+
+    def handle_deaths(self, deaths):
+        """
+        Removes the actors that died during a step from the registry and the
+        grid, then spawns their replacements. Humans that don't resettle are
+        replaced on their own square first, so that no resettling human can
+        take that square; then the resettling humans and the mosquitos are
+        placed, in the order in which they died.
+        """
+        grid = self.grid
+        cells = [grid.cell_of(obj) for obj in deaths]
+        for obj in deaths:
+            self.actors.remove(obj)
+            self.counts[type(obj).__name__].remove(obj)
+            grid.remove(obj)
+
+        replace = []
+        for obj, cell in zip(deaths, cells):
+            if not obj.is_human():
+                replace.append(self.new_mosquito)
+            elif self.random.random() < self.config.Human.resettle_chance:
+                replace.append(self.new_human)
+            else:
+                use_net = self.use_net and self.random.random() < self.config.Human.use_net_chance
+                self.spawn_actor(Human, GridSquareProxy(grid, *grid.pos(cell)), use_net=use_net)
+
+        for spawn in replace:
+            spawn()
+
     def handle_death(self, obj):
         cur_square = self.grid.get_square(obj)
         self.actors.remove(obj)
-        self.grid.get_square(obj).remove(obj)
+        self.counts[type(obj).__name__].remove(obj)
+        self.grid.remove(obj)
         if obj.is_human():
-            if random.random() < self.config.Human.resettle_chance:
+            if self.random.random() < self.config.Human.resettle_chance:
                 self.new_human()
             else:
                 use_net = False
 
-                if self.use_net and random.random() < self.config.Human.use_net_chance:
+                if self.use_net and self.random.random() < self.config.Human.use_net_chance:
                     use_net = True
 
                 self.spawn_actor(Human, cur_square, use_net=use_net)
@@ -259,56 +841,188 @@ class Simulation:
 
     def new_human(self):
         square = None
-        if self.config.Human.cluster and random.random() < self.config.Human.cluster_chance:
-            neigh_coords = [*itertools.product((-1, 0, 1), (-1, 0, 1))]
-            neigh_coords.remove((0, 0))
-            humans = [*filter(Actor.is_human, self.actors)]
-            random.shuffle(humans)
-            for h in humans:
-                x_h, y_h = self.grid.get_square(h).pos
-                for x_off, y_off in neigh_coords:
-                    try:
-                        t_square = self.grid[x_h + x_off, y_h + y_off]
-                        if not_contains_class(Human)(t_square):
-                            square = t_square
-                            break
-                    except ValueError:
-                        pass
-                if square:
-                    break
+        if self.config.Human.cluster and self.random.random() < self.config.Human.cluster_chance:
+            square = self.grid.get_random_cluster_square()
         if square is None:
-            if self.spawned_mosquitos:
-                square = self.grid.get_random_square(predicate=not_contains_class(Human))
-                pass
-            else:
-                while True:
-                    index = random.randrange(self.grid.x_max), random.randrange(self.grid.y_max)
-                    if not self.grid[index]:
-                        square = self.grid[index]
-                        break
+            square = self.grid.get_random_free_square()
 
         use_net = False
 
-        if self.use_net and random.random() < self.config.Human.use_net_chance:
+        if self.use_net and self.random.random() < self.config.Human.use_net_chance:
             use_net = True
 
         return self.spawn_actor(Human, square, use_net=use_net)
 
     def new_mosquito(self):
         if (self.spawned_mosquitos and self.config.Mosquito.cluster and
-            random.random() < self.config.Mosquito.cluster_chance):
-                square = self.grid.get_square(random.choice([*filter(Actor.is_mosquito, self.actors)]))
+            self.random.random() < self.config.Mosquito.cluster_chance):
+                square = self.mosquito_cluster_square()
+                if square is None:
+                    return None
         else:
             self.spawned_mosquitos = True
             square = self.grid.get_random_square()
-        vaccinated = self.vax_mosquitos and random.random() < self.config.Mosquito.vax_rate
+        vaccinated = self.vax_mosquitos and self.random.random() < self.config.Mosquito.vax_rate
         return self.spawn_actor(Mosquito, square, vaccinated)
 
+    def mosquito_cluster_square(self):
+        """ Returns the square of a uniformly chosen mosquito. """
+        return self.grid.get_square(self.actors.random_choice(Mosquito))
+
     def spawn_actor(self, cls, square, vax=False, use_net=False):
         obj = cls(self, self.config, has_vaccine=vax, use_net=use_net)
         square.add(obj)
-        self.actors.append(obj)
+        self.actors.add(obj)
+        self.counts[cls.__name__].add(obj)
         return obj
 
+    def flag_changed(self, obj, flag, delta):
+        """ Called by spawned actors when one of their counted flags changes. """
+        counts = obj.counts
+        setattr(counts, flag, getattr(counts, flag) + delta)
+        self.grid.flag_changed(obj, flag, delta)
+
     def num_actors(self):
         return len(self.actors)
+
+    def binomial(self, n, p):
+        """ Returns the number of successes of n checks with chance p. """
+        return sum(self.random.random() < p for _ in range(n))
+
+    def snapshot(self):
+        """
+        Returns the state of the simulation as plain data: the actors (as
+        columns per class, in registry order), grid occupancy, time,
+        intervention flags, stats history and random state.
+        """
+        classes = [Human, Mosquito]
+        code = {cls: i for i, cls in enumerate(classes)}
+        members = {cls: self.actors.of_class(cls) for cls in classes}
+        row = {actor: i for cls in classes for i, actor in enumerate(members[cls])}
+
+        actors = {}
+        for cls in classes:
+            actors[cls.__name__] = {
+                'cells': array('q', (self.grid.cell_of(a) for a in members[cls])),
+                'fields': {field: column([getattr(a, field) for a in members[cls]])
+                           for field in state_fields(cls)},
+            }
+
+        return {
+            't': self.t,
+            'flags': {flag: getattr(self, flag) for flag in self.flags},
+            'batch_deaths': self.batch_deaths,
+            'classes': [cls.__name__ for cls in classes],
+            'order_class': array('b', (code[type(a)] for a in self.actors)),
+            'order_row': array('q', (row[a] for a in self.actors)),
+            'actors': actors,
+            'grid_index': self.grid.get_index_state(),
+            'stats': self.stats.get_state(),
+            'fast_random': not type(self.random) is random.Random,
+            'random': self.random.getstate(),
+        }
+
+    def restore(self, snapshot):
+        """ Replaces the state of the simulation by that of a snapshot. """
+        self.random = make_rng(fast=snapshot['fast_random'])
+        self.random.setstate(snapshot['random'])
+        self.grid = self.make_grid()
+        self.counts = {'Human': ActorCounts(), 'Mosquito': ActorCounts()}
+        self.t = snapshot['t']
+        for flag, value in snapshot['flags'].items():
+            setattr(self, flag, value)
+        self.batch_deaths = snapshot.get('batch_deaths', True)
+        self.deaths = []
+        self.stats.set_state(snapshot['stats'])
+
+        classes = [globals()[name] for name in snapshot['classes']]
+        members = {}
+        for cls in classes:
+            state = snapshot['actors'][cls.__name__]
+            members[cls] = []
+            columns = [(field, values, values.typecode == 'b')
+                       for field, values in state['fields'].items()]
+            for i, cell in enumerate(state['cells']):
+                obj = self.make_actor(cls, ((field, bool(values[i]) if is_bool else values[i])
+                                            for field, values, is_bool in columns))
+                self.grid.place(obj, cell)
+                self.counts[cls.__name__].add(obj)
+                members[cls].append(obj)
+
+        actors = [members[classes[c]][r]
+                  for c, r in zip(snapshot['order_class'], snapshot['order_row'])]
+        self.actors = ActorRegistry.from_lists(self.random, actors, members)
+        self.grid.set_index_state(snapshot['grid_index'])
+
+    def make_actor(self, cls, fields):
+        """
+        Returns an actor of cls in this simulation whose state fields (see
+        state_fields) are set from the (field, value) pairs in fields,
+        without running its __init__ or adding it anywhere.
+        """
+        obj = cls.__new__(cls)
+        obj.sim, obj.global_config = self, self.config
+        obj.config = getattr(self.config, cls.__name__)
+        obj.counts = None
+        for field, value in fields:
+            setattr(obj, field, value)
+        return obj
+
+    @classmethod
+    def from_snapshot(cls, config, snapshot):
+        sim = cls(config, populate=False)
+        sim.restore(snapshot)
+        return sim
+
+    def fork(self, seed=None):
+        """
+        Returns an independent copy of this simulation. The copy continues
+        exactly like this simulation would, unless it is given a new seed
+        (see reseed).
+        """
+        sim = self.from_snapshot(self.config, self.snapshot())
+        if seed is not None:
+            sim.reseed(seed)
+        return sim
+
+    def reseed(self, seed):
+        """
+        Seeds every random generator of the simulation from seed. Engines
+        with generators of their own reseed those too.
+        """
+        self.random.seed(seed)
+
+    def save_checkpoint(self, path):
+        """ Writes a compressed snapshot of the simulation to path. """
+        with open(path, 'wb') as f:
+            f.write(self.checkpoint_magic)
+            f.write(zlib.compress(pickle.dumps(self.snapshot(), pickle.HIGHEST_PROTOCOL)))
+
+    @classmethod
+    def load_checkpoint(cls, config, path):
+        """ Returns the simulation saved to path by save_checkpoint. """
+        with open(path, 'rb') as f:
+            if f.read(len(cls.checkpoint_magic)) != cls.checkpoint_magic:
+                raise ValueError(f"{path} is not a simulation checkpoint")
+            return cls.from_snapshot(config, pickle.loads(zlib.decompress(f.read())))
+
+def state_fields(cls):
+    """ Returns the slots of an actor class that hold simulation state. """
+    return [field for supercls in reversed(cls.mro())
+            for field in supercls.__dict__.get('__slots__', ())
+            if field not in Actor._fields]
+
+def column(values):
+    """
+    Packs a list of bools, ints or floats into a compact array. Bools are
+    stored with typecode 'b', so they can be restored as bools.
+    """
+    if all(type(v) is bool for v in values):
+        return array('b', values)
+    if all(type(v) is int for v in values):
+        return array('q', values)
+    return array('d', values)
+
+if __name__ == '__main__':
+    import headless
+    headless.main()
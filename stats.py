@@ -1,5 +1,11 @@
+import ast
+import csv
 import inspect
-import matplotlib.pyplot as plt
+import itertools
+import os
+import sys
+import zipfile
+from array import array
 
 
 def stat_fn(m):
@@ -12,10 +18,90 @@ def stat_fn(m):
 def is_stat_fn(fn):
     return hasattr(fn, "_is_stat_fn")
 
+class Series:
+    """
+    A growing series of floats. The values are stored in a preallocated
+    array of doubles whose capacity doubles whenever it is full.
+    """
+    def __init__(self, values=(), capacity=1024):
+        self._buffer = array('d', bytes(8 * max(capacity, len(values), 1)))
+        self._n = 0
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        if self._n == len(self._buffer):
+            self._buffer.extend(self._buffer)
+        self._buffer[self._n] = value
+        self._n += 1
+
+    @property
+    def values(self):
+        """ Returns a copy of the values as an array('d'). """
+        return self._buffer[:self._n]
+
+    def tolist(self):
+        return self.values.tolist()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._n)
+            if step > 0:
+                # Sliced from the buffer, so only the slice is copied.
+                return self._buffer[start:stop:step]
+            return self.values[i]
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError("Series index out of range")
+        return self._buffer[i]
+
+    def __iter__(self):
+        return itertools.islice(self._buffer, self._n)
+
+    def __len__(self):
+        return self._n
+
+    def __repr__(self):
+        return f"Series({self.tolist()})"
+
+class ActorCounts:
+    """
+    Running totals for the live actors of one class. The simulation adds
+    actors when they spawn and removes them when they die, and the actors
+    update the totals themselves whenever one of the counted flags changes.
+    """
+    flags = ('infected', 'immune', 'vaccinated')
+
+    def __init__(self):
+        self.population = 0
+        self.infected = 0
+        self.immune = 0
+        self.vaccinated = 0
+
+    def add(self, actor):
+        self.population += 1
+        for flag in self.flags:
+            if getattr(actor, flag):
+                setattr(self, flag, getattr(self, flag) + 1)
+        actor.counts = self
+
+    def remove(self, actor):
+        actor.counts = None
+        self.population -= 1
+        for flag in self.flags:
+            if getattr(actor, flag):
+                setattr(self, flag, getattr(self, flag) - 1)
+
 class SimStats():
     """
-    Keeps stats for all actors in the current simulation
+    Keeps stats for all actors in the current simulation.
+
+    The stats are read from the simulation's ActorCounts, so computing
+    them does not depend on the number of actors.
     """
+    modes = {'h': 'Human', 'm': 'Mosquito'}
+
     def __init__(self, sim):
         self.stat_fns = inspect.getmembers(self, predicate=is_stat_fn)
         
@@ -27,27 +113,35 @@ class SimStats():
         for f_name, f in self.stat_fns:
             self.data[f_name] = {}
             for m in f._modes:
-                self.data[f_name][m] = []
+                self.data[f_name][m] = Series()
+        self._dump = None
+
+    def columns(self):
+        """ Returns the (stat, mode) pairs of all series, in a fixed order. """
+        return [(f_name, m) for f_name, f in self.stat_fns for m in f._modes]
+
+    def get_state(self):
+        """ Returns a copy of all series, as a dict of dicts of arrays. """
+        return {f_name: {m: series.values for m, series in modes.items()}
+                for f_name, modes in self.data.items()}
+
+    def set_state(self, state):
+        self.data = {f_name: {m: Series(values) for m, values in modes.items()}
+                     for f_name, modes in state.items()}
+        self._dump = None
         
+    def counts(self, mode):
+        return self.sim.counts.get(self.modes.get(mode))
+
     @stat_fn("hm")
     def population(self, mode):
-        f = "is_human" if mode == 'h' else "is_mosquito" if mode == 'm' else None
-        if not f: return 0
-        n = 0
-        for a in self.sim.actors:
-            if getattr(a, f)():
-                n += 1
-        return n
+        counts = self.counts(mode)
+        return counts.population if counts else 0
     
     @stat_fn("hm")
     def infected_absolute(self, mode):
-        f = "is_human" if mode == 'h' else "is_mosquito" if mode == 'm' else None
-        if not f: return 0
-        n = 0
-        for a in self.sim.actors:
-            if getattr(a, f)() and a.infected:
-                n += 1
-        return n
+        counts = self.counts(mode)
+        return counts.infected if counts else 0
     
     @stat_fn("hm")
     def infected_percentage(self, mode):
@@ -55,38 +149,144 @@ class SimStats():
     
     @stat_fn("h")
     def resistance_percentage(self, mode):
-        n = 0
-        for a in self.sim.actors:
-            if getattr(a, 'is_human')() and a.immune:
-                n += 1
+        n = self.sim.counts['Human'].immune
         return (n / self.population(mode)) * 100
         
     @stat_fn("hm")
     def vaccinated_percentage(self, mode):
-        f = "is_human" if mode == 'h' else "is_mosquito" if mode == 'm' else None
-        if not f: return 0
-        n = 0
-        for a in self.sim.actors:
-            if getattr(a, f)() and a.vaccinated:
-                n += 1
-        return (n / self.population(mode)) * 100
+        counts = self.counts(mode)
+        if not counts: return 0
+        return (counts.vaccinated / self.population(mode)) * 100
         
     def step(self):
         for f_name, f in self.stat_fns:
             for m in f._modes:
                 self.data[f_name][m].append(f(m))
+
+        if self._dump and self._dump.every and self.n_steps() % self._dump.every == 0:
+            self.dump()
+
+    def n_steps(self):
+        """ Returns the number of steps recorded. """
+        f_name, m = self.columns()[0]
+        return len(self.data[f_name][m])
         
-    def plot(self, stat, mode, t_start=0, t_end=None, save_fig=False):
-        t_end = t_end or self.sim.t
-        plt.clf()
-        for m in mode:
-            plt.plot(range(t_start, t_end), self.data[stat][m])
-        plt.xlabel('time')
-        plt.ylabel(stat)
-        plt.legend(mode)
-        plt.show()
-        if save_fig:
-            plt.savefig(f"plots/plot_{stat}_{mode}_{t_start}-{t_end}.png")
+    def plot(self, stat, mode, t_start=0, t_end=None, save_fig=False, show=True):
+        """ Plots the series of stat for every mode in mode (see plot_panels). """
+        return self.plot_panels([(stat, mode)], t_start, t_end, save_fig, show)
+
+    def plot_panels(self, panels, t_start=0, t_end=None, save_fig=False, show=True):
+        """
+        Plots a figure with a panel per (stat, mode) pair in a background
+        process (see plotting.plot), and returns the process.
+        """
+        # Imported here, so that importing stats doesn't pay for
+        # multiprocessing; matplotlib is only imported by the plot process.
+        import plotting
+
+        return plotting.plot(self.data, panels, t_start, t_end, save_fig, show)
             
-    def dump(self, path):
-        pass
\ No newline at end of file
+    def dump(self, path=None, format=None, every=None):
+        """
+        Appends the steps recorded since the previous dump to disk.
+
+        The first call chooses the path and format; later calls (without
+        arguments) append to it. format 'npy' writes every dump as a new
+        .npz chunk (one .npy array per stat and mode) in the directory path,
+        and 'csv' appends rows to the file path. The default format is 'csv'
+        for paths ending in .csv and 'npy' otherwise. With every, step()
+        dumps automatically every that many steps. Read dumps back with
+        load_dump().
+        """
+        if path is not None:
+            format = format or ('csv' if path.endswith('.csv') else 'npy')
+            self._dump = DumpWriter(path, format, self.columns(), every)
+        elif self._dump is None:
+            raise ValueError("No dump path given")
+        self._dump.write(self.data, self.n_steps())
+
+class DumpWriter:
+    """ Appends new samples of SimStats series to a dump on disk. """
+    def __init__(self, path, format, columns, every=None):
+        if format not in ('npy', 'csv'):
+            raise ValueError(f"Unknown dump format '{format}'")
+        self.path, self.format, self.columns, self.every = path, format, columns, every
+        self.written = 0
+        self.chunks = 0
+
+        if format == 'npy':
+            # Chunks of an earlier dump to path would be read back with
+            # this one, so they are removed, like csv truncates its file.
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                if name.startswith('chunk_') and name.endswith('.npz'):
+                    os.remove(os.path.join(path, name))
+        else:
+            with open(path, 'w', newline='') as f:
+                csv.writer(f).writerow(['t'] + [f"{f_name}_{m}" for f_name, m in columns])
+
+    def write(self, data, n):
+        if n <= self.written:
+            return
+        start, self.written = self.written, n
+        segments = {f"{f_name}_{m}": data[f_name][m][start:n] for f_name, m in self.columns}
+
+        if self.format == 'csv':
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.writer(f)
+                for i in range(n - start):
+                    writer.writerow([start + i] + [segments[name][i] for name in segments])
+            return
+
+        segments['t'] = array('d', range(start, n))
+        chunk = os.path.join(self.path, f"chunk_{self.chunks:06d}.npz")
+        with zipfile.ZipFile(chunk, 'w') as f:
+            for name, values in segments.items():
+                f.writestr(name + '.npy', npy_bytes(values))
+        self.chunks += 1
+
+def npy_bytes(values):
+    """ Returns an array('d') in the .npy file format. """
+    if sys.byteorder != 'little':
+        values = array('d', values)
+        values.byteswap()
+    header = f"{{'descr': '<f8', 'fortran_order': False, 'shape': ({len(values)},), }}"
+    header += ' ' * (-(len(header) + 11) % 64) + '\n'
+    return (b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') +
+            header.encode('latin1') + values.tobytes())
+
+def npy_values(data):
+    """ Returns the values of a one-dimensional '<f8' .npy file as an array('d'). """
+    header_len = int.from_bytes(data[8:10], 'little')
+    header = ast.literal_eval(data[10:10 + header_len].decode('latin1'))
+    if header['descr'] != '<f8':
+        raise ValueError(f"Unsupported dtype {header['descr']}")
+    values = array('d', data[10 + header_len:])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+def load_dump(path):
+    """
+    Reads a dump written by SimStats.dump. Returns a dict mapping
+    '<stat>_<mode>' (and 't') to an array of all dumped values.
+    """
+    series = {}
+    if os.path.isfile(path):
+        with open(path, newline='') as f:
+            rows = csv.reader(f)
+            names = next(rows)
+            series = {name: array('d') for name in names}
+            for row in rows:
+                for name, value in zip(names, row):
+                    series[name].append(float(value))
+        return series
+
+    for chunk in sorted(os.listdir(path)):
+        if not chunk.endswith('.npz'):
+            continue
+        with zipfile.ZipFile(os.path.join(path, chunk)) as f:
+            for name in f.namelist():
+                series.setdefault(name[:-len('.npy')], array('d')).extend(
+                    npy_values(f.read(name)))
+    return series
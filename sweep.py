@@ -0,0 +1,228 @@
+"""
+Ensemble and parameter-sweep engine.
+
+Expands a grid of config parameters into (config, seed) jobs, runs every job
+headless in a pool of worker processes and yields the stats of every run as
+soon as it finishes:
+
+    python -m simulate sweep --param Mosquito.bite_chance=0.25,0.35 \
+        --param Human.use_net_chance=0.1,0.5 --seeds 20 --steps 1000 \
+        --output sweep.jsonl
+
+With --aggregate, the series of the runs are merged per parameter set (see
+ensemble.Ensemble) instead of written per run, and one line of per-step
+aggregates is written per parameter set at the end.
+"""
+import collections
+import concurrent.futures
+import importlib
+import itertools
+import json
+import os
+import time
+import traceback
+
+import convergence
+import ensemble
+import headless
+
+
+Job = collections.namedtuple(
+    'Job', 'config params seed steps interventions engine stop min_steps fast_forward',
+    defaults=('config', (), None, 1000, (), 'object', (), 0, False))
+Job.__doc__ = """
+A single headless run: the name of the config module, the parameters that
+override it (a tuple of ('Class.attribute', value) pairs), the seed, the
+number of steps, the interventions ((t, name) pairs, see headless.run), the
+engine, and the stop specs (see convergence.make_stop), the steps before
+which they aren't checked and whether to fast-forward after extinction.
+"""
+
+Result = collections.namedtuple('Result', 'job data final elapsed error stop_reason stop_t',
+                                defaults=(None, None))
+Result.__doc__ = """
+The outcome of a Job: the SimStats series (see SimStats.get_state) and
+final values, the time the run took, the formatted traceback if it failed
+(in which case data and final are None), and why and at which time the run
+stopped early, if it did.
+"""
+
+
+def override_config(base, params):
+    """
+    Returns a config with the same classes as the config module base, where
+    every ('Class.attribute', value) in params overrides that attribute.
+    """
+    overrides = collections.defaultdict(dict)
+    for name, value in params:
+        cls_name, attr = name.split('.')
+        if not hasattr(getattr(base, cls_name), attr):
+            raise AttributeError(f"{base.__name__}.{cls_name} has no attribute {attr}")
+        overrides[cls_name][attr] = value
+
+    classes = {name: type(name, (cls,), overrides[name])
+               for name, cls in vars(base).items()
+               if isinstance(cls, type) and cls.__module__ == base.__name__}
+    return type(base.__name__, (), classes)
+
+
+def expand_grid(grid):
+    """
+    Expands a dict mapping 'Class.attribute' to a list of values into a list
+    of parameter tuples, one for every combination of values.
+    """
+    names = sorted(grid)
+    return [tuple(zip(names, values))
+            for values in itertools.product(*(grid[name] for name in names))]
+
+
+def make_jobs(param_sets, seeds, **kwargs):
+    """ Returns a Job for every combination of parameter set and seed. """
+    return [Job(params=tuple(params), seed=seed, **kwargs)
+            for params in param_sets for seed in seeds]
+
+
+def run_job(job):
+    """ Runs a job. Called in the worker processes. """
+    config = override_config(importlib.import_module(job.config), job.params)
+    start = time.perf_counter()
+    sim = headless.make_simulation(config, job.seed, job.engine)
+    stop = convergence.make_stop(job.stop, job.min_steps)
+    headless.run(sim, job.steps, job.interventions, stop=stop)
+    headless.close(sim)
+    headless.finish_early(sim, stop, job.steps, job.fast_forward)
+    return Result(job, sim.stats.get_state(), headless.final_stats(sim.stats),
+                  time.perf_counter() - start, None, stop.reason, stop.t)
+
+
+def failed(job, error):
+    return Result(job, None, None, 0, error)
+
+
+def sweep(jobs, max_workers=None, retries=1, max_pending=None):
+    """
+    Runs the jobs in a process pool and yields a Result for every job, in
+    the order in which they finish. At most max_pending jobs (by default
+    twice the number of workers) are submitted at a time, so memory doesn't
+    grow with the number of jobs.
+
+    A job that raises yields a Result with the error. If a worker process
+    dies, the pool breaks; the jobs that had not finished are then run
+    again in a new pool, at most retries times.
+    """
+    max_workers = max_workers or os.cpu_count()
+    max_pending = max_pending or 2 * max_workers
+    pending = list(jobs)
+    for attempt in range(retries + 1):
+        if not pending:
+            return
+        broken = []
+        queue = iter(pending)
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            futures = {}
+            while True:
+                if not broken:
+                    for job in itertools.islice(queue, max_pending - len(futures)):
+                        futures[pool.submit(run_job, job)] = job
+                if not futures:
+                    break
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    # Popped, so that the result can be freed once it is used.
+                    job = futures.pop(future)
+                    try:
+                        yield future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        broken.append(job)
+                    except Exception:
+                        yield failed(job, traceback.format_exc())
+            broken.extend(queue)
+        pending = broken
+
+    for job in pending:
+        yield failed(job, "worker process died")
+
+
+def write_result(f, result):
+    """ Writes a result to f as a single JSON line. """
+    record = {
+        'params': dict(result.job.params),
+        'seed': result.job.seed,
+        'elapsed': result.elapsed,
+        'error': result.error,
+        'stop_reason': result.stop_reason,
+        'stop_t': result.stop_t,
+        'final': result.final and {f"{name}[{mode}]": value
+                                   for (name, mode), value in result.final.items()},
+        'data': result.data and {f_name: {m: values.tolist() for m, values in modes.items()}
+                                 for f_name, modes in result.data.items()},
+    }
+    f.write(json.dumps(record) + '\n')
+    f.flush()
+
+
+def write_ensemble(f, params, aggregate):
+    """ Writes the aggregates of the runs of a parameter set as a JSON line. """
+    record = {
+        'params': dict(params),
+        'n_runs': aggregate.n_runs,
+        'ensemble': aggregate.summary(),
+    }
+    f.write(json.dumps(record) + '\n')
+    f.flush()
+
+
+def parse_param(text):
+    """ Parses 'Class.attribute=v1,v2,...' into a name and a list of values. """
+    name, values = text.split('=', 1)
+    return name, [json.loads(value) for value in values.split(',')]
+
+
+def add_arguments(parser):
+    parser.add_argument('--param', type=parse_param, action='append', default=[],
+                        metavar='Class.attribute=V1,V2,...',
+                        help="values of a config parameter to sweep over")
+    parser.add_argument('--seeds', type=int, default=1,
+                        help="number of seeded replicates per parameter set")
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--config', default='config',
+                        help="module to read the configuration from")
+    parser.add_argument('--engine', choices=headless.ENGINES, default='object')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default='sweep.jsonl',
+                        help="file to append one JSON line per run to")
+    parser.add_argument('--aggregate', action='store_true',
+                        help="merge the series of the runs of every parameter set "
+                             "instead of writing them per run")
+
+
+def main(args):
+    jobs = make_jobs(expand_grid(dict(args.param)),
+                     range(args.first_seed, args.first_seed + args.seeds),
+                     config=args.config, steps=args.steps,
+                     interventions=tuple(args.interventions), engine=args.engine,
+                     stop=headless.stop_specs(args), min_steps=args.min_steps,
+                     fast_forward=args.fast_forward)
+
+    start = time.perf_counter()
+    n_failed = 0
+    aggregates = {}
+    with open(args.output, 'a') as f:
+        for i, result in enumerate(sweep(jobs, args.workers), 1):
+            if args.aggregate and not result.error:
+                aggregates.setdefault(result.job.params, ensemble.Ensemble()).add(result.data)
+                result = result._replace(data=None)
+            write_result(f, result)
+            status = f"failed:\n{result.error}" if result.error else f"{result.elapsed:.2f}s"
+            if result.stop_reason:
+                status += f", stopped at t={result.stop_t} ({result.stop_reason})"
+            n_failed += bool(result.error)
+            print(f"[{i}/{len(jobs)}] {dict(result.job.params)} seed={result.job.seed}: {status}")
+        for params, aggregate in aggregates.items():
+            write_ensemble(f, params, aggregate)
+
+    elapsed = time.perf_counter() - start
+    print(f"Ran {len(jobs)} jobs ({n_failed} failed) in {elapsed:.2f}s "
+          f"on {args.workers or os.cpu_count()} workers")
@@ -0,0 +1,452 @@
+"""
+Tiled simulation engine.
+
+Splits the grid into rectangular tiles and steps every tile in its own
+worker process. Each tile is a TileSimulation: an ordinary Simulation over
+its part of the grid, with its own seeded random generator, surrounded by
+a one-square halo of the neighbouring tiles.
+
+A step runs in two rounds. First every tile steps on its own: mosquitos
+that move across the tile edge end up in the halo, and deaths and respawns
+are resolved within the tile. Then the actors in the halos are handed to
+the tiles that own those squares, and every tile reports its ActorCounts,
+from which the global SimStats are computed.
+
+A clustered mosquito respawns next to a uniformly chosen mosquito of the
+whole grid, as in Simulation: the tile first picks a tile, weighted by the
+number of mosquitos in it, and asks that tile to spawn the mosquito if it
+isn't itself.
+
+A clustered human that resettles is placed next to a uniformly chosen
+human of its own tile, which can be across the tile edge: every tile
+reports which of its edge squares hold humans in the second round, and the
+other tiles see those in their halo during the next step. A human placed in
+the halo is handed to the tile that owns the square, like a mosquito. This
+differs from Simulation in three ways:
+- the human next to which it is placed is chosen within the tile only;
+- the halo is a step behind;
+- two tiles can pick the same square, in which case the owning tile places
+  the second human on a random free square of its own.
+While the grid is populated, the halo counts as occupied.
+
+With a fixed seed and tile layout, runs are reproducible. Within a step, a
+mosquito that crossed an edge doesn't bite until the next step.
+"""
+import bisect
+import importlib
+import multiprocessing
+import random
+import types
+from array import array
+
+from simulate import Simulation, Grid, GridSquareProxy, Human, Mosquito, state_fields
+from stats import SimStats, ActorCounts
+
+
+class TileLayout:
+    """
+    Splits a grid of the given size into tiles[0] columns and tiles[1] rows
+    of tiles, as equal in size as possible.
+    """
+    def __init__(self, size, tiles):
+        self.size = size
+        self.tiles = tiles
+        self.x_edges = split(size[0], tiles[0])
+        self.y_edges = split(size[1], tiles[1])
+
+    def __len__(self):
+        return self.tiles[0] * self.tiles[1]
+
+    def bounds(self, index):
+        """ Returns (x, y, width, height) of a tile. """
+        i, j = divmod(index, self.tiles[1])
+        x, y = self.x_edges[i], self.y_edges[j]
+        return x, y, self.x_edges[i + 1] - x, self.y_edges[j + 1] - y
+
+    def tile_of(self, pos):
+        """ Returns the index of the tile that contains the global pos. """
+        i = bisect.bisect_right(self.x_edges, pos[0]) - 1
+        j = bisect.bisect_right(self.y_edges, pos[1]) - 1
+        return i * self.tiles[1] + j
+
+    def share(self, n, index):
+        """ Returns the part of n actors that falls on a tile, by area. """
+        total = self.size[0] * self.size[1]
+        before = sum(self.area(i) for i in range(index))
+        return (n * (before + self.area(index))) // total - (n * before) // total
+
+    def area(self, index):
+        _, _, w, h = self.bounds(index)
+        return w * h
+
+
+def split(n, parts):
+    return [n * i // parts for i in range(parts + 1)]
+
+
+class TileGrid(Grid):
+    """
+    The grid of one tile, with a halo around it.
+
+    Cells 0 to n_cells - 1 are the squares of the tile. The squares of the
+    neighbouring tiles that can be reached with a single move get the cell
+    ids after that; halo_pos maps them to their global position. The grid
+    remembers the actors placed in the halo (emigrants) so they can be
+    handed over at the end of the step.
+
+    The free-cell index also covers the halo: a halo cell that holds a
+    human (see set_halo_humans) counts as occupied for the humans of the
+    tile around it, and a free one as a free neighbour.
+    """
+    def __init__(self, x_max, y_max, rng, origin, global_size):
+        self.origin = origin
+        self.global_size = global_size
+        self.halo_pos = []
+        self.emigrants = []
+        # The cells of the tile around every halo cell, and the cells of
+        # the tile that are in the halo of another tile.
+        self.halo_neighbours = {}
+        border = set()
+        halo = {}
+        n_moves = len(self.move_offsets)
+        table = array('l', [-1]) * (n_moves * x_max * y_max)
+        for x in range(x_max):
+            for y in range(y_max):
+                for k, (x_off, y_off) in enumerate(self.move_offsets):
+                    nx, ny = x + x_off, y + y_off
+                    gx, gy = origin[0] + nx, origin[1] + ny
+                    if 0 <= nx < x_max and 0 <= ny < y_max:
+                        target = nx * y_max + ny
+                    elif 0 <= gx < global_size[0] and 0 <= gy < global_size[1]:
+                        if (gx, gy) not in halo:
+                            halo[gx, gy] = x_max * y_max + len(self.halo_pos)
+                            self.halo_pos.append((gx, gy))
+                        target = halo[gx, gy]
+                        self.halo_neighbours.setdefault(target, []).append(x * y_max + y)
+                        border.add(x * y_max + y)
+                    else:
+                        continue
+                    table[n_moves * (x * y_max + y) + k] = target
+        self.n_total = x_max * y_max + len(self.halo_pos)
+
+        self.halo = halo
+        self.border = sorted(border)
+
+        super().__init__(x_max, y_max, rng)
+        self._neighbours = table + array('l', [-1]) * (n_moves * len(self.halo_pos))
+        # Halo cells hold 0 while occupied and -1 while free; all are
+        # occupied until the first set_halo_humans.
+        self._free_neighbours.extend(array('l', [0]) * len(self.halo_pos))
+
+    def _new_cells(self):
+        return [None] * self.n_total
+
+    def _new_counts(self):
+        return array('l', [0]) * self.n_total
+
+    def local_cell(self, pos):
+        """ Returns the cell of a global position inside this tile. """
+        return self.cell((pos[0] - self.origin[0], pos[1] - self.origin[1]))
+
+    def place(self, obj, cell):
+        super().place(obj, cell)
+        if cell >= self.n_cells:
+            self.emigrants.append(obj)
+
+    def border_humans(self):
+        """ Returns the global positions of the edge squares that hold humans. """
+        counts = self.counts[Human]
+        x0, y0 = self.origin
+        return [(x0 + x, y0 + y) for x, y in
+                (self.pos(cell) for cell in self.border if counts[cell])]
+
+    def set_halo_humans(self, positions):
+        """ Marks the halo squares at the global positions as holding humans. """
+        occupied = {self.halo[pos] for pos in positions if pos in self.halo}
+        for cell in range(self.n_cells, self.n_total):
+            if (cell in occupied) != (self._free_neighbours[cell] >= 0):
+                self._set_halo_human(cell, cell in occupied)
+
+    def _set_halo_human(self, cell, occupied):
+        self._free_neighbours[cell] = 0 if occupied else -1
+        delta = -1 if occupied else 1
+        for n_cell in self.halo_neighbours[cell]:
+            if self._free_neighbours[n_cell] >= 0:
+                self._set_free_neighbours(n_cell, self._free_neighbours[n_cell] + delta)
+
+    def get_random_cluster_square(self):
+        """
+        Like Grid.get_random_cluster_square, but the square can be in the
+        halo.
+        """
+        if not self._open:
+            return None
+        cell = self._open.random_choice(self.random)
+        for n_cell in self.neighbours(cell):
+            if self._free_neighbours[n_cell] < 0:
+                return GridSquareProxy(self, *self.pos(n_cell))
+
+    def _occupy(self, cell):
+        if cell < self.n_cells:
+            super()._occupy(cell)
+        else:
+            self._set_halo_human(cell, True)
+
+    def _vacate(self, cell):
+        # A human only leaves the halo to move to the tile that owns the
+        # square, so the square stays occupied.
+        if cell < self.n_cells:
+            super()._vacate(cell)
+
+    def _set_free_neighbours(self, cell, n):
+        # The free neighbours of halo cells aren't counted.
+        if cell < self.n_cells:
+            super()._set_free_neighbours(cell, n)
+
+
+class TileSimulation(Simulation):
+    """
+    The simulation of one tile of a TiledSimulation. Only the first tile
+    infects a human when populating the grid. config can also be the name
+    of a config module, which is then imported.
+    """
+    def __init__(self, config, layout, index, seed=None, fast_random=False):
+        if isinstance(config, str):
+            config = importlib.import_module(config)
+        self.layout = layout
+        self.index = index
+        x, y, w, h = layout.bounds(index)
+        self.origin = (x, y)
+        self.seed_infection = index == 0
+        self.tile_weights = None
+        self.remote_spawns = []
+        super().__init__(tile_config(config, layout, index), seed, fast_random)
+
+    def make_grid(self):
+        return TileGrid(*self.config.Grid.size, self.random, self.origin, self.layout.size)
+
+    def mosquito_cluster_square(self):
+        """
+        Picks a tile weighted by its number of mosquitos. If that is another
+        tile, asks it to spawn the mosquito instead and returns None.
+        """
+        if self.tile_weights:
+            r = self.random.random() * self.tile_weights[-1]
+            tile = bisect.bisect_right(self.tile_weights, r)
+            if tile != self.index:
+                self.remote_spawns.append(tile)
+                return None
+        return super().mosquito_cluster_square()
+
+    def spawn_remote(self):
+        """ Spawns a mosquito that another tile asked for. """
+        if self.actors.count(Mosquito):
+            square = super().mosquito_cluster_square()
+        else:
+            square = self.grid.get_random_square()
+        vaccinated = self.vax_mosquitos and self.random.random() < self.config.Mosquito.vax_rate
+        self.spawn_actor(Mosquito, square, vaccinated)
+
+    def take_emigrants(self):
+        """
+        Removes the actors in the halo and returns them as (global pos,
+        class name, fields) tuples, in the order in which they entered the
+        halo.
+        """
+        grid = self.grid
+        emigrants = []
+        for obj in grid.emigrants:
+            cell = grid._cell_of.get(obj)
+            if cell is None or cell < grid.n_cells:
+                continue
+            cls = type(obj)
+            emigrants.append((grid.halo_pos[cell - grid.n_cells], cls.__name__,
+                              [(field, getattr(obj, field)) for field in state_fields(cls)]))
+            self.actors.remove(obj)
+            self.counts[cls.__name__].remove(obj)
+            grid.remove(obj)
+        grid.emigrants = []
+        return emigrants
+
+    def add_immigrant(self, pos, cls_name, fields):
+        """
+        Adds an actor that another tile placed at pos. A human whose square
+        has been taken in the meantime goes to a random free square.
+        """
+        cls = Human if cls_name == 'Human' else Mosquito
+        obj = self.make_actor(cls, fields)
+        cell = self.grid.local_cell(pos)
+        if cls is Human and self.grid.counts[Human][cell] and self.grid._free:
+            cell = self.grid.get_random_free_square().cell
+        self.grid.place(obj, cell)
+        self.actors.add(obj)
+        self.counts[cls_name].add(obj)
+
+    # Requests from the TiledSimulation.
+
+    def do_step(self, flags, tile_weights, border_humans):
+        for flag, value in flags.items():
+            setattr(self, flag, value)
+        self.tile_weights = tile_weights
+        self.grid.set_halo_humans(border_humans)
+        self.step()
+        spawns, self.remote_spawns = self.remote_spawns, []
+        return self.take_emigrants(), spawns
+
+    def do_settle(self, immigrants, spawns):
+        for immigrant in immigrants:
+            self.add_immigrant(*immigrant)
+        for _ in range(spawns):
+            self.spawn_remote()
+        return self.report()
+
+    def report(self):
+        """ Returns the ActorCounts of the tile and its edge squares with humans. """
+        counts = {name: tuple(getattr(counts, flag) for flag in COUNTED)
+                  for name, counts in self.counts.items()}
+        return counts, self.grid.border_humans()
+
+
+COUNTED = ('population',) + ActorCounts.flags
+
+
+def tile_config(config, layout, index):
+    """ Returns config with the grid and population of one tile. """
+    _, _, w, h = layout.bounds(index)
+
+    class Tile:
+        class Mosquito(config.Mosquito):
+            n = layout.share(config.Mosquito.n, index)
+
+        class Human(config.Human):
+            n = layout.share(config.Human.n, index)
+
+        class Grid(config.Grid):
+            size = (w, h)
+    return Tile
+
+
+def serve(conn, *args):
+    """ Runs a TileSimulation in a worker process, answering requests. """
+    tile = TileSimulation(*args)
+    conn.send(tile.report())
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        name, request_args = request
+        conn.send(getattr(tile, 'do_' + name)(*request_args))
+    conn.close()
+
+
+class LocalTile:
+    """ Runs a TileSimulation in this process, behind the same interface. """
+    def __init__(self, *args):
+        self.tile = TileSimulation(*args)
+        self.reply = self.tile.report()
+
+    def send(self, request):
+        if request is not None:
+            name, request_args = request
+            self.reply = getattr(self.tile, 'do_' + name)(*request_args)
+
+    def recv(self):
+        return self.reply
+
+
+class TiledSimulation:
+    """
+    Represents a simulation that is split into tiles, which are stepped in
+    parallel by worker processes (or in this process, if processes is
+    False). Call close() to stop the workers.
+
+    Exposes t, stats, counts, num_actors() and the intervention flags like
+    Simulation, so it can be run by headless.run.
+    """
+    flags = ('vax_mosquitos', 'use_net')
+
+    def __init__(self, config, tiles=(2, 2), seed=None, fast_random=False, processes=True):
+        self.config = config
+        self.layout = TileLayout(config.Grid.size, tiles)
+        self.t = 0
+        self.vax_mosquitos = False
+        self.use_net = False
+
+        # Modules can't be pickled, so worker processes that are spawned
+        # rather than forked import a config module by name.
+        if isinstance(config, types.ModuleType):
+            config = config.__name__
+        seeds = random.Random(seed)
+        self.conns = []
+        self.processes = []
+        for index in range(len(self.layout)):
+            args = (config, self.layout, index, seeds.getrandbits(64), fast_random)
+            if processes:
+                conn, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=serve, args=(child,) + args,
+                                                  daemon=True)
+                process.start()
+                self.processes.append(process)
+                self.conns.append(conn)
+            else:
+                self.conns.append(LocalTile(*args))
+
+        self.stats = SimStats(self)
+        self.receive_counts()
+
+    def step(self):
+        self.t += 1
+        self.stats.step()
+
+        flags = {flag: getattr(self, flag) for flag in self.flags}
+        weights = self.tile_weights()
+        for conn in self.conns:
+            conn.send(('step', (flags, weights, self.border_humans)))
+        results = [conn.recv() for conn in self.conns]
+
+        immigrants = [[] for _ in self.conns]
+        spawns = [0] * len(self.conns)
+        for emigrants, remote_spawns in results:
+            for emigrant in emigrants:
+                immigrants[self.layout.tile_of(emigrant[0])].append(emigrant)
+            for tile in remote_spawns:
+                spawns[tile] += 1
+        for conn, tile_immigrants, n in zip(self.conns, immigrants, spawns):
+            conn.send(('settle', (tile_immigrants, n)))
+        self.receive_counts()
+
+    def receive_counts(self):
+        replies = [conn.recv() for conn in self.conns]
+        self.tile_counts = [counts for counts, _ in replies]
+        # Sent to every tile with the next step (see TileGrid.set_halo_humans).
+        self.border_humans = [pos for _, border in replies for pos in border]
+        self.counts = {}
+        for name in ('Human', 'Mosquito'):
+            counts = ActorCounts()
+            for flag, value in zip(COUNTED, map(sum, zip(*(c[name] for c in self.tile_counts)))):
+                setattr(counts, flag, value)
+            self.counts[name] = counts
+
+    def tile_weights(self):
+        """ Returns the cumulative number of mosquitos per tile. """
+        weights, total = [], 0
+        for counts in self.tile_counts:
+            total += counts['Mosquito'][0]
+            weights.append(total)
+        return weights
+
+    def num_actors(self):
+        return sum(counts.population for counts in self.counts.values())
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,363 @@
+"""
+Vectorised simulation engine.
+
+Keeps the state of every actor in NumPy arrays (struct-of-arrays) instead of
+one Python object per actor, and advances the whole population with batched
+array operations. It reads the same config.Mosquito/config.Human/config.Grid
+parameters as Simulation and feeds the same SimStats series.
+"""
+import numpy as np
+from simulate import Mosquito
+from stats import SimStats
+
+
+HUMAN_FIELDS = {
+    'pos': np.int64,
+    'age': np.int64,
+    'infected': bool,
+    'immune': bool,
+    'vaccinated': bool,
+    'use_net': bool,
+    'infection_time': np.int64,
+    'infection_count': np.int64,
+}
+
+MOSQUITO_FIELDS = {
+    'pos': np.int64,
+    'hunger': np.float64,
+    'age': np.int64,
+    'infected': bool,
+    'vaccinated': bool,
+    'infection_time': np.int64,
+    'infection_count': np.int64,
+}
+
+
+def neighbour_table(x_max, y_max):
+    """
+    Returns an (x_max * y_max, 8) array with the cell ids of the neighbours of
+    every cell, in the order of Mosquito.possible_moves. Neighbours outside of
+    the grid are -1. Cell (x, y) has id x * y_max + y.
+    """
+    x, y = np.divmod(np.arange(x_max * y_max), y_max)
+    table = np.empty((x_max * y_max, len(Mosquito.possible_moves)), dtype=np.int64)
+    for i, (x_off, y_off) in enumerate(Mosquito.possible_moves):
+        nx, ny = x + x_off, y + y_off
+        inside = (nx >= 0) & (nx < x_max) & (ny >= 0) & (ny < y_max)
+        table[:, i] = np.where(inside, nx * y_max + ny, -1)
+    return table
+
+
+class ActorArrays:
+    """ Struct-of-arrays storage for all actors of one class. """
+    def __init__(self, fields, n):
+        self.fields = fields
+        self.n = n
+        for name, dtype in fields.items():
+            setattr(self, name, np.zeros(n, dtype=dtype))
+
+    def reset(self, idx):
+        """ Resets the actors at the given indices to freshly spawned state. """
+        for name in self.fields:
+            getattr(self, name)[idx] = 0
+
+    def __len__(self):
+        return self.n
+
+
+class VectorSimulation:
+    """
+    Represents a simulation in which the actors are stored as arrays.
+
+    Every step runs the same phases as Simulation.step (move, bite, infection,
+    resistance and death), but each phase is applied to all actors at once
+    against the state at the start of that phase, instead of one actor after
+    the other. Dead actors are respawned into their own array slot, so the
+    population sizes stay constant, as they do in Simulation.
+    """
+    def __init__(self, config, seed=None):
+        self.config = config
+        self.x_max, self.y_max = config.Grid.size
+        self.n_cells = self.x_max * self.y_max
+        self.rng = np.random.default_rng(seed)
+        self.t = 0
+        self.spawned_mosquitos = False
+        self.vax_mosquitos = False
+        self.use_net = False
+
+        self.neighbours = neighbour_table(self.x_max, self.y_max)
+        self.human_at = np.full(self.n_cells, -1, dtype=np.int64)
+        self.stats = SimStats(self)
+
+        self.populate_grid()
+        self.counts = {'Human': ArrayCounts(self.humans),
+                       'Mosquito': ArrayCounts(self.mosquitos)}
+
+    def step(self):
+        self.t += 1
+        self.stats.step()
+
+        self.move_mosquitos()
+        self.bite()
+        self.mosquitos.hunger += 1
+        dead_mosquitos = self.mosquito_deaths()
+        dead_humans = self.human_step()
+
+        self.respawn_mosquitos(dead_mosquitos)
+        self.respawn_humans(dead_humans)
+
+    def populate_grid(self):
+        self.populate_human()
+        self.populate_mosquito()
+
+    def populate_human(self):
+        cfg = self.config.Human
+        n = cfg.n if cfg.populate_absolute else round(cfg.dens * self.n_cells)
+        self.humans = ActorArrays(HUMAN_FIELDS, n)
+        self.humans.pos[:] = -1
+
+        for i in range(n):
+            self.humans.pos[i] = self.new_human_square(i)
+            self.human_at[self.humans.pos[i]] = i
+
+        infected = self.rng.random(n) < cfg.pre_infection_prob
+        infected[:1] = True
+        self.infect(self.humans, np.flatnonzero(infected))
+
+    def populate_mosquito(self):
+        cfg = self.config.Mosquito
+        n = cfg.n
+        self.mosquitos = ActorArrays(MOSQUITO_FIELDS, n)
+        self.mosquitos.hunger[:] = cfg.fed_hunger
+        if not n:
+            return
+
+        # Mosquito i either picks a random square, or (when clustering) the
+        # square of a uniformly chosen earlier mosquito. Resolve those chains
+        # by pointer jumping, so every mosquito ends up with a root that
+        # picked a random square.
+        root = np.arange(n)
+        if cfg.cluster:
+            clustered = self.rng.random(n) < cfg.cluster_chance
+            clustered[0] = False
+            parents = (self.rng.random(n) * root).astype(np.int64)
+            root = np.where(clustered, parents, root)
+            while True:
+                next_root = root[root]
+                if np.array_equal(next_root, root):
+                    break
+                root = next_root
+        squares = self.rng.integers(self.n_cells, size=n)
+        self.mosquitos.pos[:] = squares[root]
+        self.spawned_mosquitos = True
+
+    def new_human_square(self, n_placed):
+        """
+        Picks a square for a new human, like Simulation.new_human: either a
+        free square next to an existing human, or a random free square.
+        Only the humans with an index below n_placed are considered.
+        """
+        cfg = self.config.Human
+        if cfg.cluster and self.rng.random() < cfg.cluster_chance:
+            square = self.cluster_square(n_placed)
+            if square >= 0:
+                return square
+        return self.random_free_square()
+
+    def cluster_square(self, n_placed, max_tries=64):
+        """
+        Returns a free square next to a uniformly chosen human that has a
+        free neighbour, or -1 if no human has one.
+        """
+        if not n_placed:
+            return -1
+        humans = self.humans
+        for _ in range(max_tries):
+            pos = humans.pos[self.rng.integers(n_placed)]
+            if pos < 0:
+                continue
+            free = self.free_neighbours(pos)
+            if len(free):
+                return free[0]
+
+        # Most humans are surrounded; find the candidates exhaustively.
+        placed = humans.pos[:n_placed]
+        placed = placed[placed >= 0]
+        neigh = self.neighbours[placed]
+        free = (neigh >= 0) & (self.human_at[neigh] < 0)
+        candidates = np.flatnonzero(free.any(axis=1))
+        if not len(candidates):
+            return -1
+        choice = candidates[self.rng.integers(len(candidates))]
+        return neigh[choice][free[choice]][0]
+
+    def free_neighbours(self, pos):
+        neigh = self.neighbours[pos]
+        neigh = neigh[neigh >= 0]
+        return neigh[self.human_at[neigh] < 0]
+
+    def random_free_square(self, max_tries=64):
+        """ Returns a uniformly chosen square that contains no human. """
+        for _ in range(max_tries):
+            square = self.rng.integers(self.n_cells)
+            if self.human_at[square] < 0:
+                return square
+        free = np.flatnonzero(self.human_at < 0)
+        return free[self.rng.integers(len(free))]
+
+    def move_mosquitos(self):
+        m = self.mosquitos
+        moving = np.flatnonzero(self.rng.random(m.n) < self.config.Mosquito.move_chance)
+        moves = self.rng.integers(self.neighbours.shape[1], size=len(moving))
+        new_pos = self.neighbours[m.pos[moving], moves]
+
+        # Moves that would leave the grid are not made.
+        inside = new_pos >= 0
+        m.pos[moving[inside]] = new_pos[inside]
+
+    def bite(self):
+        cfg = self.config.Mosquito
+        m = self.mosquitos
+        max_hunger = -cfg.fed_hunger
+
+        will_bite = self.rng.random(m.n) < cfg.bite_chance * (m.hunger / max_hunger)
+        will_bite &= m.hunger >= 0
+        will_bite &= self.human_at[m.pos] >= 0
+
+        biters = np.flatnonzero(will_bite)
+        if not len(biters):
+            return
+        bitten = self.human_at[m.pos[biters]]
+
+        nut_value = self.rng.random(len(biters)) * (cfg.fed_hunger - cfg.base_bite_nutrition)
+        m.hunger[biters] -= cfg.base_bite_nutrition + nut_value
+
+        self.get_bitten(bitten, biters)
+
+    def get_bitten(self, bitten, biters):
+        """ Applies Human.get_bitten to every (human, mosquito) bite pair. """
+        h, m = self.humans, self.mosquitos
+
+        vaccinated = bitten[m.vaccinated[biters]]
+        h.vaccinated[vaccinated] = True
+        h.infected[vaccinated] = False
+        h.immune[vaccinated] = False
+
+        h_infected = h.infected[bitten]
+        m_infected = m.infected[biters]
+        exposed = ((h_infected | m_infected) & ~h.vaccinated[bitten] &
+                   ~h.use_net[bitten])
+
+        to_mosquito = exposed & h_infected & (
+            self.rng.random(len(biters)) < self.config.Human.mosquito_infection_chance)
+        m_infected = m_infected | (to_mosquito & ~m.vaccinated[biters])
+        to_human = exposed & m_infected & (
+            self.rng.random(len(biters)) < self.config.Mosquito.human_infection_chance)
+
+        self.infect(m, biters[to_mosquito])
+        self.infect(h, bitten[to_human])
+
+    def infect(self, actors, idx):
+        """ Applies Infectable.infect once for every (possibly repeated) index. """
+        idx = idx[~actors.vaccinated[idx]]
+        new = np.unique(idx[~actors.infected[idx]])
+        actors.infection_time[new] = self.t
+        actors.infected[idx] = True
+        np.add.at(actors.infection_count, idx, 1)
+
+    def mosquito_deaths(self):
+        m = self.mosquitos
+        return np.flatnonzero(self.rng.random(m.n) < self.config.Mosquito.simple_death_chance)
+
+    def human_step(self):
+        """ Runs resistance, natural death and malaria death for all humans. """
+        cfg = self.config.Human
+        h = self.humans
+
+        resistance_chance = cfg.resistance_base + h.infection_count * cfg.infection_resistance_factor
+        h.immune |= h.infected & (self.rng.random(h.n) < resistance_chance)
+
+        dead = self.rng.random(h.n) < h.age * cfg.age_death_factor + cfg.death_base
+        h.age += 1
+
+        dur_fac = (self.t - h.infection_time) / 10000
+        ill = h.infected & ~h.immune
+        dead |= ill & (self.rng.random(h.n) < cfg.malaria_death_chance + dur_fac)
+        return np.flatnonzero(dead)
+
+    def respawn_mosquitos(self, dead):
+        if not len(dead):
+            return
+        cfg = self.config.Mosquito
+        m = self.mosquitos
+
+        alive = np.ones(m.n, dtype=bool)
+        alive[dead] = False
+        alive = np.flatnonzero(alive)
+
+        pos = self.rng.integers(self.n_cells, size=len(dead))
+        if cfg.cluster and len(alive):
+            clustered = self.rng.random(len(dead)) < cfg.cluster_chance
+            parents = alive[self.rng.integers(len(alive), size=np.count_nonzero(clustered))]
+            pos[clustered] = m.pos[parents]
+
+        m.reset(dead)
+        m.pos[dead] = pos
+        m.hunger[dead] = cfg.fed_hunger
+        if self.vax_mosquitos:
+            m.vaccinated[dead] = self.rng.random(len(dead)) < cfg.vax_rate
+
+    def respawn_humans(self, dead):
+        if not len(dead):
+            return
+        cfg = self.config.Human
+        h = self.humans
+
+        resettle = self.rng.random(len(dead)) < cfg.resettle_chance
+        pos = h.pos[dead]
+        h.reset(dead)
+        h.pos[dead] = pos
+
+        # Humans that don't resettle are replaced on the same square, so only
+        # the squares of resettling humans become free.
+        movers = dead[resettle]
+        self.human_at[h.pos[movers]] = -1
+        h.pos[movers] = -1
+        for i in movers:
+            h.pos[i] = self.new_human_square(h.n)
+            self.human_at[h.pos[i]] = i
+
+        if self.use_net:
+            h.use_net[dead] = self.rng.random(len(dead)) < cfg.use_net_chance
+
+    def num_actors(self):
+        return len(self.humans) + len(self.mosquitos)
+
+
+class ArrayCounts:
+    """
+    Exposes the same totals as stats.ActorCounts, counted from the arrays of
+    one actor class.
+    """
+    def __init__(self, actors):
+        self.actors = actors
+
+    def count(self, flag):
+        values = getattr(self.actors, flag, None)
+        return int(np.count_nonzero(values)) if values is not None else 0
+
+    @property
+    def population(self):
+        return len(self.actors)
+
+    @property
+    def infected(self):
+        return self.count('infected')
+
+    @property
+    def immune(self):
+        return self.count('immune')
+
+    @property
+    def vaccinated(self):
+        return self.count('vaccinated')